@@ -0,0 +1,87 @@
+from tortoise import Tortoise, run_async
+from models import *
+from time import perf_counter
+import numpy as np
+import sys
+
+# JOB CLAIM BENCHMARK SCRIPT -----
+# Compares the old `ORDER BY RANDOM()` job claim against the indexed claim in models.py.
+# Usage: python bench_claim.py <db_url> [claims per run]
+# IMPORTANT: Run this against an empty scratch database, as the `job` table is filled with dummy data and wiped afterwards.
+# (Postgres only, as the claim queries use `FOR UPDATE SKIP LOCKED`)
+
+SIZES = [1_000_000, 10_000_000]
+
+OLD_QUERY_CPU_HYBRID = """
+UPDATE "job"
+SET pending=true, completor='{}'
+WHERE "number" IN
+    (
+     SELECT "number" FROM "job"
+     WHERE pending=false AND closed=false AND gpu=false
+     ORDER BY RANDOM() LIMIT 1
+     FOR UPDATE SKIP LOCKED
+    )
+  AND pending=false AND closed=false AND gpu=false
+;
+"""
+
+SEED_QUERY = """
+INSERT INTO "job" ("number", "url", "start_id", "end_id", "shard_of_chunk", "gpu", "pending", "closed")
+SELECT n, 'crawl-data/' || (n / 2) || '.warc.wat.gz', ((n / 2)::bigint * 1000000)::text, ((n / 2 + 1)::bigint * 1000000)::text, n % 2,
+       false, false, RANDOM() < 0.5
+FROM generate_series({}, {}) AS n;
+"""
+
+async def _time_claims(conn, query, claims):
+    timings = []
+    for i in range(claims):
+        start = perf_counter()
+        await conn.execute_query(query.format(f"bench-{i}"))
+        timings.append((perf_counter() - start) * 1000)
+
+    # Release the claimed jobs so each run starts from the same state.
+    await conn.execute_query("""UPDATE "job" SET pending=false, completor=NULL WHERE pending=true;""")
+
+    timings = np.array(timings)
+    return f"mean {timings.mean():.2f}ms, p50 {np.percentile(timings, 50):.2f}ms, p99 {np.percentile(timings, 99):.2f}ms"
+
+async def init():
+    if len(sys.argv) < 2:
+        print("Usage: python bench_claim.py <db_url> [claims per run]")
+        return
+
+    claims = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    await Tortoise.init(
+        db_url=sys.argv[1],
+        modules={'models': ['models']}
+    )
+    await Tortoise.generate_schemas()
+    conn = Tortoise.get_connection("default")
+
+    if await Job.all().count() > 0:
+        print("The `job` table is not empty - refusing to overwrite it. Use a scratch database.")
+        return
+
+    await conn.execute_script(CUSTOM_QUERY_INDEXES)
+
+    seeded = 0
+    for size in SIZES:
+        print(f"Seeding {size:,} jobs...")
+        for start in range(seeded + 1, size + 1, 1_000_000):
+            await conn.execute_query(SEED_QUERY.format(start, min(start + 999_999, size)))
+        seeded = size
+        await conn.execute_script("""ANALYZE "job";""")
+
+        print(f"[{size:,} jobs] old claim: " + await _time_claims(conn, OLD_QUERY_CPU_HYBRID, claims))
+        print(f"[{size:,} jobs] new claim: " + await _time_claims(conn, CUSTOM_QUERY_CPU_HYBRID, claims))
+
+    await conn.execute_query("""DELETE FROM "job";""")
+    await Tortoise.close_connections()
+
+    print("Done.")
+
+
+
+run_async(init())
@@ -0,0 +1,313 @@
+import argparse
+import asyncio
+import subprocess
+import json
+from contextvars import ContextVar
+from time import perf_counter, time
+from aioredis.utils import from_url
+from tortoise import Tortoise
+from tortoise.backends.asyncpg.client import AsyncpgDBClient
+from models import Job, Client, Leaderboard, CPU_Leaderboard, CUSTOM_QUERY_INDEXES
+import numpy as np
+import httpx
+import config
+
+# LOAD TEST / BENCHMARK SCRIPT -----
+# Runs the server in-process and drives simulated CPU and GPU workers through the worker protocol:
+# /api/new -> /api/newJob -> /api/updateProgress (x k) -> /api/markAsDone -> ... -> /api/bye
+# GPU workers process the jobs completed by the CPU workers, and dashboard viewers can optionally load the dashboard pages at the same time.
+# Reports the throughput, p50/p99 latency and database queries per request of each endpoint, and saves the results as JSON to compare between commits.
+# Usage: python benchmark.py <db_url> <redis_url> [--jobs N] [--cpu-workers N] [--gpu-workers N] [--output results.json] (see --help for more options)
+# IMPORTANT: Run this against an empty scratch database and Redis database, as both are filled with dummy data and wiped afterwards.
+# (Postgres only, as the claim queries use `FOR UPDATE SKIP LOCKED`)
+
+SEED_QUERY = """
+INSERT INTO "job" ("number", "url", "start_id", "end_id", "shard_of_chunk", "gpu", "pending", "closed")
+SELECT n, 'crawl-data/' || (n / 2) || '.warc.wat.gz', ((n / 2)::bigint * 1000000)::text, ((n / 2 + 1)::bigint * 1000000)::text, n % 2,
+       false, false, false
+FROM generate_series({}, {}) AS n;
+"""
+
+# The database client methods counted as queries.
+QUERY_METHODS = ["execute_insert", "execute_many", "execute_query", "execute_query_dict", "execute_script"]
+
+DASHBOARD_PAGES = ["/", "/leaderboard", "/data"]
+
+# The list counting the queries made whilst handling the current request. (None outside of a request, e.g. in the background tasks)
+_queries = ContextVar("queries", default=None)
+
+
+def _count_queries(client_class):
+    """ Patches the database client class `client_class` (and its subclasses) to count each query made against the current request. """
+    def _wrap(method):
+        async def _counted(*args, **kwargs):
+            queries = _queries.get()
+            if queries is not None:
+                queries[0] += 1
+            return await method(*args, **kwargs)
+        return _counted
+
+    for name in QUERY_METHODS:
+        setattr(client_class, name, _wrap(getattr(client_class, name)))
+
+    # Subclasses which override a method (e.g. the transaction wrapper) are patched separately.
+    for subclass in client_class.__subclasses__():
+        for name in QUERY_METHODS:
+            if name in subclass.__dict__:
+                setattr(subclass, name, _wrap(subclass.__dict__[name]))
+
+
+class Stats:
+    def __init__(self):
+        """ The latency, status code and query count of every request made, by endpoint. """
+        self.requests = {}
+        self.jobs = 0
+
+    def record(self, path, status, duration, queries) -> None:
+        """ Records a request to `path`. """
+        endpoint = self.requests.setdefault(path, {"durations": [], "queries": [], "statuses": {}})
+        endpoint["durations"].append(duration)
+        endpoint["queries"].append(queries)
+        endpoint["statuses"][str(status)] = endpoint["statuses"].get(str(status), 0) + 1
+
+    def summary(self, duration) -> dict:
+        """ Returns the results of a run which took `duration` seconds. """
+        endpoints = {}
+        for path, endpoint in sorted(self.requests.items()):
+            durations = np.array(endpoint["durations"]) * 1000
+            endpoints[path] = {
+                "requests": len(durations),
+                "requests_per_second": len(durations) / duration,
+                "statuses": endpoint["statuses"],
+                "mean_ms": durations.mean(),
+                "p50_ms": np.percentile(durations, 50),
+                "p99_ms": np.percentile(durations, 99),
+                "queries_per_request": np.mean(endpoint["queries"])
+            }
+
+        requests = sum(endpoint["requests"] for endpoint in endpoints.values())
+        return {
+            "duration": duration,
+            "requests": requests,
+            "requests_per_second": requests / duration,
+            "jobs_completed": self.jobs,
+            "jobs_per_second": self.jobs / duration,
+            "endpoints": endpoints
+        }
+
+
+async def _request(http, stats, method, path, **kwargs):
+    """ Makes a request to the server, recording its latency and the number of queries it made. """
+    queries = [0]
+    token = _queries.set(queries)
+    try:
+        start = perf_counter()
+        r = await http.request(method, path, **kwargs)
+        stats.record(path, r.status_code, perf_counter() - start, queries[0])
+    finally:
+        _queries.reset(token)
+
+    return r
+
+
+async def _cpu_worker(http, stats, args, index):
+    r = await _request(http, stats, "GET", "/api/new", params={"nickname": f"benchmark-{index % args.users}", "type": "CPU"})
+    token = r.json()["token"]
+
+    for _ in range(args.jobs_per_worker):
+        if args.claim == "chunk":
+            r = await _request(http, stats, "POST", "/api/newChunk", json={"token": token, "type": "CPU"})
+        else:
+            r = await _request(http, stats, "POST", "/api/newJob", json={"token": token, "type": "CPU"})
+        if r.status_code != 200:
+            break
+        jobs = r.json() if args.claim == "chunk" else [r.json()]
+
+        for i in range(args.progress_updates):
+            await _request(http, stats, "POST", "/api/updateProgress", json={"token": token, "type": "CPU", "progress": f"Processing {i + 1}/{args.progress_updates}"})
+
+        # The URL is later downloaded by the GPU worker processing the job.
+        if args.claim == "chunk":
+            done = [{"number": job["number"], "url": f"benchmark/{job['number']}.tar"} for job in jobs]
+            r = await _request(http, stats, "POST", "/api/markJobsAsDone", json={"token": token, "type": "CPU", "jobs": done})
+        else:
+            r = await _request(http, stats, "POST", "/api/markAsDone", json={"token": token, "type": "CPU", "url": f"benchmark/{jobs[0]['number']}.tar"})
+        if r.status_code == 200:
+            stats.jobs += len(jobs)
+
+    await _request(http, stats, "POST", "/api/bye", json={"token": token, "type": "CPU"})
+
+
+async def _gpu_worker(http, stats, args, index, cpu_done):
+    r = await _request(http, stats, "GET", "/api/new", params={"nickname": f"benchmark-{index % args.users}", "type": "GPU"})
+    token = r.json()["token"]
+
+    completed = 0
+    while completed < args.jobs_per_worker:
+        r = await _request(http, stats, "POST", "/api/newJob", json={"token": token, "type": "GPU"})
+        if r.status_code != 200:
+            # GPU jobs are created by the CPU workers, so we keep retrying until they have all finished.
+            if cpu_done.is_set():
+                break
+            await asyncio.sleep(args.retry_delay)
+            continue
+
+        for i in range(args.progress_updates):
+            await _request(http, stats, "POST", "/api/updateProgress", json={"token": token, "type": "GPU", "progress": f"Processing {i + 1}/{args.progress_updates}"})
+
+        r = await _request(http, stats, "POST", "/api/markAsDone", json={"token": token, "type": "GPU", "count": 10_000})
+        if r.status_code == 200:
+            stats.jobs += 1
+        completed += 1
+
+    await _request(http, stats, "POST", "/api/bye", json={"token": token, "type": "GPU"})
+
+
+async def _viewer(http, stats, args, done):
+    while not done.is_set():
+        for page in DASHBOARD_PAGES:
+            await _request(http, stats, "GET", page)
+        await asyncio.sleep(args.view_interval)
+
+
+async def _is_empty(db_url):
+    """ Returns True if the database at `db_url` has no jobs, clients or leaderboard entries, connecting to it directly rather than through the server. """
+    await Tortoise.init(db_url=db_url, modules={"models": ["models"]})
+    try:
+        await Tortoise.generate_schemas()
+        for model in [Job, Client, Leaderboard, CPU_Leaderboard]:
+            if await model.all().count() > 0:
+                print(f"The `{model._meta.db_table}` table is not empty - refusing to overwrite it. Use a scratch database.")
+                return False
+        return True
+    finally:
+        await Tortoise.close_connections()
+
+
+async def _seed(main, args):
+    """ Fills the empty scratch database with `args.jobs` open jobs. """
+    conn = Tortoise.get_connection("default")
+    print(f"Seeding {args.jobs:,} jobs...")
+    for start in range(1, args.jobs + 1, 1_000_000):
+        await conn.execute_query(SEED_QUERY.format(start, min(start + 999_999, args.jobs)))
+    await conn.execute_script(CUSTOM_QUERY_INDEXES)
+    await conn.execute_script("""ANALYZE "job";""")
+
+    counts = {"open": args.jobs, "pending": 0, "gpu": 0, "closed": 0}
+    counts.update({f"clients:{type}": 0 for type in main.cache.counters.CLIENT_TYPES})
+    await main.cache.counters.set_all(counts)
+    await main.cache.client.mset({"pairs": 0, "ml-pairs": 0, "nl-pairs": 0, "eta": "Calculating..."})
+
+
+def _stop(main):
+    """ Stops the background tasks. """
+    main.app.state.leader.cancel()
+    main.stop_leader_tasks()
+
+
+async def _cleanup():
+    """ Empties the scratch database. """
+    conn = Tortoise.get_connection("default")
+    await conn.execute_script("""DELETE FROM "client"; DELETE FROM "job"; DELETE FROM "leaderboard"; DELETE FROM "cpu_leaderboard";""")
+
+
+async def benchmark(args):
+    # The server reads its settings from config.py when it is imported, so they are overridden first.
+    config.SQL_CONN_URL = args.db_url
+    config.REDIS_CONN_URL = args.redis_url
+    config.PAGE_CACHE_PREWARM = args.prewarm
+    config.NOLANG_PAIRS_URL = "http://127.0.0.1:9/" # (the real pairs count is not polled during the benchmark)
+
+    redis = from_url(args.redis_url)
+    if await redis.dbsize() > 0:
+        print("The Redis database is not empty - refusing to overwrite it. Use a scratch database. (e.g. redis://localhost/15)")
+        return
+
+    # The database is checked before the server starts, as its background tasks would otherwise already be running against it.
+    if not await _is_empty(args.db_url):
+        await redis.close()
+        return
+
+    import main
+    _count_queries(AsyncpgDBClient)
+
+    stats = Stats()
+    seeded = False
+    try:
+        async with main.app.router.lifespan_context(main.app):
+            try:
+                await _seed(main, args)
+                seeded = True
+
+                # Give the zero worker time to be elected and fill the job queues, as it would be on a running server.
+                await asyncio.sleep(args.warmup)
+
+                print(f"Running {args.cpu_workers:,} CPU workers and {args.gpu_workers:,} GPU workers ({args.jobs_per_worker:,} jobs each)...")
+                transport = httpx.ASGITransport(app=main.app)
+                async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as http:
+                    cpu_done, done = asyncio.Event(), asyncio.Event()
+                    viewers = [asyncio.create_task(_viewer(http, stats, args, done)) for _ in range(args.viewers)]
+
+                    start = perf_counter()
+                    cpu = asyncio.gather(*[_cpu_worker(http, stats, args, i) for i in range(args.cpu_workers)])
+                    gpu = asyncio.gather(*[_gpu_worker(http, stats, args, i, cpu_done) for i in range(args.gpu_workers)])
+                    await cpu
+                    cpu_done.set()
+                    await gpu
+                    duration = perf_counter() - start
+
+                    done.set()
+                    await asyncio.gather(*viewers)
+            finally:
+                _stop(main)
+                if seeded:
+                    await _cleanup()
+    finally:
+        await redis.flushdb()
+        await redis.close()
+
+    results = stats.summary(duration)
+    _print(results)
+
+    settings = {key: value for key, value in vars(args).items() if key not in ["db_url", "redis_url", "output"]}
+    with open(args.output, "w") as f:
+        json.dump({"commit": _commit(), "time": int(time()), "settings": settings, "results": results}, f, indent=4)
+    print(f"Saved the results to {args.output}.")
+
+
+def _commit():
+    """ Returns the git commit being benchmarked, or None if it cannot be found. """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _print(results):
+    print(f"\n{results['requests']:,} requests in {results['duration']:.2f}s ({results['requests_per_second']:,.1f} req/s, {results['jobs_per_second']:,.1f} jobs/s)\n")
+    print(f"{'Endpoint':<24}{'Requests':>10}{'Req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'Queries':>10}  Statuses")
+    for path, endpoint in results["endpoints"].items():
+        statuses = ", ".join(f"{status}: {count:,}" for status, count in sorted(endpoint["statuses"].items()))
+        print(f"{path:<24}{endpoint['requests']:>10,}{endpoint['requests_per_second']:>10,.1f}{endpoint['p50_ms']:>10.2f}{endpoint['p99_ms']:>10.2f}{endpoint['queries_per_request']:>10.2f}  {statuses}")
+    print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load tests the server with simulated workers.")
+    parser.add_argument("db_url", help="the URL of an empty scratch Postgres database")
+    parser.add_argument("redis_url", help="the URL of an empty scratch Redis database")
+    parser.add_argument("--jobs", type=int, default=1_000_000, help="the number of jobs seeded (default 1,000,000)")
+    parser.add_argument("--cpu-workers", type=int, default=500, help="the number of simulated CPU workers (default 500)")
+    parser.add_argument("--gpu-workers", type=int, default=100, help="the number of simulated GPU workers (default 100)")
+    parser.add_argument("--jobs-per-worker", type=int, default=5, help="the number of jobs each worker completes (default 5)")
+    parser.add_argument("--progress-updates", type=int, default=5, help="the number of progress updates sent for each job (default 5)")
+    parser.add_argument("--claim", choices=["job", "chunk"], default="job", help="how CPU workers claim jobs: one shard at a time (/api/newJob) or every shard of a chunk (/api/newChunk) (default job)")
+    parser.add_argument("--users", type=int, default=50, help="the number of user nicknames the workers are spread across (default 50)")
+    parser.add_argument("--viewers", type=int, default=0, help="the number of simulated dashboard viewers (default 0)")
+    parser.add_argument("--view-interval", type=float, default=1, help="the number of seconds between each viewer loading the dashboard pages (default 1)")
+    parser.add_argument("--retry-delay", type=float, default=0.5, help="the number of seconds GPU workers wait before retrying when there are no GPU jobs (default 0.5)")
+    parser.add_argument("--warmup", type=float, default=5, help="the number of seconds the server runs before the workers start (default 5)")
+    parser.add_argument("--prewarm", action="store_true", help="enable PAGE_CACHE_PREWARM")
+    parser.add_argument("--output", default="benchmark.json", help="the file the results are saved to (default benchmark.json)")
+
+    asyncio.run(benchmark(parser.parse_args()))
@@ -1,15 +1,97 @@
 import asyncio
+import gzip
+import json
+from hashlib import sha1
 from os import getpid
+from socket import gethostname
 from time import time
-from typing import Optional, Tuple
-from config import PAGE_CACHE_EXPIRY
+from random import shuffle
+from uuid import uuid4
+from collections import OrderedDict
+from typing import List, Optional
+from config import PAGE_CACHE_EXPIRY, PAGE_RENDER_LOCK_TIMEOUT, LEADERBOARD_REBUILD_TIMEOUT, PAGE_LOCAL_CACHE_SIZE, LEADER_LEASE_TIMEOUT, LEADER_HEARTBEAT_INTERVAL, \
+                   IDLE_TIMEOUT, TOKEN_LOCAL_CACHE_SIZE, TOKEN_LOCAL_CACHE_EXPIRY, DASHBOARD_EVENT_QUEUE_SIZE, UPLOAD_ADDR_WEIGHTS, UPLOAD_FAILURE_WINDOW, UPLOAD_FAILURE_THRESHOLD
+
+try:
+    import brotli
+except ImportError:
+    brotli = None # Brotli compression is optional, and pages are only compressed using gzip if it is not installed.
 
 from aioredis.utils import from_url
 from aioredis.client import Redis
 
+class _PageEntry:
+    def __init__(self, body: bytes, expires: int, etag: Optional[str] = None, variants: Optional[dict] = None):
+        """ A rendered page, pre-encoded as `body`, along with its ETag and any compressed variants of it. """
+        self.body = body
+        self.expires = expires
+        self.etag = etag or f'W/"{sha1(body).hexdigest()}"'
+        self._variants = variants or {}
+    
+    @property
+    def expired(self) -> bool:
+        """ Returns True if the page has expired. """
+        return int(time()) > self.expires
+    
+    def encoded(self, encoding) -> bytes:
+        """ Returns the page body compressed using `encoding` (gzip/br), or the plain body if `encoding` is None. """
+        if encoding is None:
+            return self.body
+        
+        if encoding not in self._variants:
+            if encoding == "br":
+                self._variants[encoding] = brotli.compress(self.body)
+            else:
+                self._variants[encoding] = gzip.compress(self.body)
+        
+        return self._variants[encoding]
+
+
+class _LocalPageCache:
+    def __init__(self, max_size: int):
+        """ A bounded, process-local LRU cache of page entries, layered in front of the Redis page cache. """
+        self._pages = OrderedDict()
+        self._max_size = max_size
+    
+    def get(self, page) -> Optional[_PageEntry]:
+        """ Returns the entry for page `page`, or None if it is not cached in this process or has expired. """
+        entry = self._pages.get(page)
+        if entry is None:
+            return None
+        
+        if entry.expired:
+            del self._pages[page]
+            return None
+        
+        self._pages.move_to_end(page)
+        return entry
+    
+    def set(self, page, entry) -> None:
+        """ Stores the entry `entry` for page `page`, discarding the least recently used page if the cache is full. """
+        self._pages[page] = entry
+        self._pages.move_to_end(page)
+        
+        while len(self._pages) > self._max_size:
+            self._pages.popitem(last=False)
+    
+    def invalidate(self, page) -> None:
+        """ Removes page `page` from the cache. """
+        self._pages.pop(page, None)
+
+
 class _PageCache:
+    # Only releases the lock if it is still held with the given token, as a slow render may outlive it and another process may have taken it since.
+    _RELEASE_LOCK_SCRIPT = """
+    if redis.call("GET", KEYS[1]) == ARGV[1] then
+        return redis.call("DEL", KEYS[1])
+    end
+    return 0
+    """
+    
     def __init__(self, client: Redis):
         self._redis = client
+        self._id = uuid4().hex
+        self.local = _LocalPageCache(PAGE_LOCAL_CACHE_SIZE)
         
     async def exists(self, page) -> bool:
         """ Returns True if page `page` exists in the cache. """
@@ -19,46 +101,687 @@ class _PageCache:
         """ Returns True if page `page` has expired in the cache. """
         return await self._redis.hget(page, "expires") > int(time())
     
-    async def set(self, page, body) -> None:
-        """ Sets the page body `body` at page `page`. Expires after `config.PAGE_CACHE_EXPIRY` seconds. """
-        await self._redis.hmset(page, {
-            "body": body,
-            "expires": int(time() + PAGE_CACHE_EXPIRY)
+    async def set(self, page, body) -> _PageEntry:
+        """ Sets the page body `body` at page `page`, along with its ETag and gzip variant, and notifies every other process to drop their local copy. Expires after `config.PAGE_CACHE_EXPIRY` seconds. """
+        entry = _PageEntry(body.encode(), int(time() + PAGE_CACHE_EXPIRY))
+        
+        # The gzip variant is compressed once here, rather than by every process serving the page.
+        await self._redis.hset(page, mapping={
+            "body": entry.body,
+            "gzip": entry.encoded("gzip"),
+            "etag": entry.etag,
+            "expires": entry.expires
         })
+        
+        self.local.set(page, entry)
+        await self._redis.publish("page-invalidate", json.dumps({"page": page, "from": self._id}))
+        
+        return entry
     
-    async def get_body_expired(self, page) -> Tuple[Optional[str], bool]:
-        """ Returns the page body, or None if expired, and whether the page has expired or not. """
-        body, expires = await self._redis.hmget(page, [
+    async def get(self, page) -> Optional[_PageEntry]:
+        """ Returns the page entry, even if it has expired, or None if it has never been cached. """
+        entry = self.local.get(page)
+        if entry is not None:
+            return entry
+        
+        body, gzipped, etag, expires = await self._redis.hmget(page, [
             "body",
+            "gzip",
+            "etag",
             "expires"
         ])
         
-        if int(time()) > int(expires):
-            return None, True
+        if body is None:
+            return None
+        
+        if gzipped is None:
+            entry = _PageEntry(body, int(expires))
         else:
-            return body, False
+            entry = _PageEntry(body, int(expires), etag.decode(), {"gzip": gzipped})
+
+        if not entry.expired:
+            self.local.set(page, entry)
+        
+        return entry
+    
+    async def listen(self) -> None:
+        """ Drops pages from this process's local cache as soon as they are re-rendered by another process. """
+        while True:
+            try:
+                pubsub = self._redis.pubsub()
+                await pubsub.subscribe("page-invalidate")
+                
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    
+                    data = json.loads(message["data"])
+                    if data["from"] != self._id:
+                        self.local.invalidate(data["page"])
+            except Exception:
+                await asyncio.sleep(5)
+    
+    async def acquire_lock(self, page) -> Optional[str]:
+        """ Returns the token of the lock for re-rendering page `page` if this process acquired it, or None if it is held by another. Expires after `config.PAGE_RENDER_LOCK_TIMEOUT` seconds. """
+        token = f"{getpid()}:{uuid4().hex}"
+        if await self._redis.set(f"render-lock:{page}", token, nx=True, ex=PAGE_RENDER_LOCK_TIMEOUT):
+            return token
+        return None
+    
+    async def release_lock(self, page, token) -> None:
+        """ Releases the lock for re-rendering page `page` if it is still held with the token `token`. """
+        await self._redis.eval(self._RELEASE_LOCK_SCRIPT, 1, f"render-lock:{page}", token)
+
+
+class _JobQueue:
+    # Pops jobs from the head of the queue until one was reserved after ARGV[1]. Jobs are pushed in order, so every job after it has not expired either.
+    _POP_EXPIRED_SCRIPT = """
+    local expired = {}
+    while true do
+        local data = redis.call("LINDEX", KEYS[1], 0)
+        if not data then
+            break
+        end
+        
+        local item = cjson.decode(data)
+        if item["reserved"] > tonumber(ARGV[1]) then
+            break
+        end
+        
+        redis.call("LPOP", KEYS[1])
+        table.insert(expired, item["job"]["number"])
+    end
+    return expired
+    """
+    
+    def __init__(self, client: Redis):
+        self._redis = client
+    
+    async def push(self, type, jobs) -> None:
+        """ Appends the reserved jobs `jobs` to the queue for worker type `type`. """
+        if not jobs:
+            return
+        
+        reserved = int(time())
+        await self._redis.rpush(f"queue:{type}", *[
+            json.dumps({"job": job, "reserved": reserved}) for job in jobs
+        ])
+    
+    async def pop(self, type) -> Optional[dict]:
+        """ Atomically pops a reserved job from the queue for worker type `type`, or returns None if the queue is empty. """
+        data = await self._redis.lpop(f"queue:{type}")
+        if data is None:
+            return None
+        return json.loads(data)["job"]
+    
+    async def length(self, type) -> int:
+        """ Returns the number of reserved jobs in the queue for worker type `type`. """
+        return await self._redis.llen(f"queue:{type}")
+    
+    async def numbers(self, type) -> List[int]:
+        """ Returns the shard numbers of every reserved job in the queue for worker type `type`. """
+        data = await self._redis.lrange(f"queue:{type}", 0, -1)
+        return [json.loads(item)["job"]["number"] for item in data]
+    
+    async def pop_expired(self, type, timeout) -> List[int]:
+        """ Atomically pops every job reserved over `timeout` seconds ago from the queue for worker type `type`, returning their shard numbers. """
+        return await self._redis.eval(self._POP_EXPIRED_SCRIPT, 1, f"queue:{type}", int(time()) - timeout)
+
+
+class _Counters:
+    # Jobs are counted in exactly one of these states. (see the state diagram in models.py)
+    JOB_STATES = ["open", "pending", "gpu", "closed"]
+    CLIENT_TYPES = ["HYBRID", "CPU", "GPU"]
+    
+    def __init__(self, client: Redis):
+        self._redis = client
+    
+    async def incr(self, key, amount=1) -> None:
+        """ Increments the counter `key` by `amount`. """
+        await self._redis.hincrby("counters", key, amount)
+    
+    async def move(self, source, destination, amount=1) -> None:
+        """ Atomically moves `amount` from the counter `source` to the counter `destination`. """
+        if source == destination or not amount:
+            return
+        
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hincrby("counters", source, -amount)
+            pipe.hincrby("counters", destination, amount)
+            await pipe.execute()
+    
+    async def get_all(self) -> dict:
+        """ Returns every counter, including the job state and client type counters which have not yet been set. """
+        data = await self._redis.hgetall("counters")
+        
+        counts = {key: 0 for key in self.JOB_STATES}
+        counts.update({f"clients:{type}": 0 for type in self.CLIENT_TYPES})
+        counts.update({key.decode(): int(value) for key, value in data.items()})
+        return counts
+    
+    async def set_all(self, counts) -> None:
+        """ Overwrites the counters with the values in `counts`. """
+        await self._redis.hset("counters", mapping=counts)
+
+
+class _Leaderboards:
+    # Boards: "gpu" (the Hybrid/GPU leaderboard, which also tracks pairs scraped) and "cpu".
+    # Only increments boards which have been built, as increments to a missing board are already included when it is rebuilt from the database.
+    # Whilst a board is being rebuilt, increments are also made to the new board, so none are lost when it replaces the old one.
+    # KEYS: the jobs and pairs of the board, its ready flag, the jobs and pairs of the board being rebuilt, then its rebuilding flag.
+    _INCR_SCRIPT = """
+    local function incr(jobs, pairs)
+        redis.call("ZINCRBY", jobs, ARGV[2], ARGV[1])
+        if tonumber(ARGV[3]) ~= 0 then
+            redis.call("HINCRBY", pairs, ARGV[1], ARGV[3])
+        end
+    end
+    
+    if redis.call("EXISTS", KEYS[3]) == 1 then
+        incr(KEYS[1], KEYS[2])
+    end
+    if redis.call("EXISTS", KEYS[6]) == 1 then
+        incr(KEYS[4], KEYS[5])
+    end
+    return 0
+    """
+    
+    # The rebuild scripts below only run if the rebuild lock (KEYS[7]) is still held with the token ARGV[1], as a slow rebuild may outlive it
+    # and another process may have started rebuilding the board since. (using the same keys as _INCR_SCRIPT, then the rebuild lock)
+    
+    # Starts making increments to the rebuilt board.
+    _START_SCRIPT = """
+    if redis.call("GET", KEYS[7]) ~= ARGV[1] then
+        return 0
+    end
+    redis.call("DEL", KEYS[4], KEYS[5])
+    redis.call("SET", KEYS[6], 1, "EX", ARGV[2])
+    return 1
+    """
+    
+    # Adds users to the rebuilt board, given as (nickname, jobs completed, pairs scraped) triples from ARGV[2].
+    _LOAD_SCRIPT = """
+    if redis.call("GET", KEYS[7]) ~= ARGV[1] then
+        return 0
+    end
+    for i = 2, #ARGV, 3 do
+        redis.call("ZINCRBY", KEYS[4], ARGV[i + 1], ARGV[i])
+        if tonumber(ARGV[i + 2]) ~= 0 then
+            redis.call("HINCRBY", KEYS[5], ARGV[i], ARGV[i + 2])
+        end
+    end
+    return 1
+    """
+    
+    # Atomically replaces the board with the rebuilt board.
+    _REPLACE_SCRIPT = """
+    if redis.call("GET", KEYS[7]) ~= ARGV[1] then
+        return 0
+    end
+    for i = 1, 2 do
+        if redis.call("EXISTS", KEYS[i + 3]) == 1 then
+            redis.call("RENAME", KEYS[i + 3], KEYS[i])
+        else
+            redis.call("DEL", KEYS[i])
+        end
+    end
+    redis.call("SET", KEYS[3], 1)
+    redis.call("DEL", KEYS[6])
+    return 1
+    """
+    
+    # Sums the jobs completed by every user on the board.
+    _TOTAL_SCRIPT = """
+    local total = 0
+    local users = redis.call("ZRANGE", KEYS[1], 0, -1, "WITHSCORES")
+    for i = 2, #users, 2 do
+        total = total + tonumber(users[i])
+    end
+    return total
+    """
+    
+    _LOAD_BATCH_SIZE = 1000 # The number of users added to the rebuilt board by each call to _LOAD_SCRIPT.
+    
+    def __init__(self, client: Redis):
+        """ The leaderboards, stored as Redis sorted sets of nicknames scored by jobs completed. (the SQL leaderboard tables remain the source of truth) """
+        self._redis = client
+    
+    @staticmethod
+    def _keys(board) -> List[str]:
+        return [
+            f"leaderboard:{board}:jobs", f"leaderboard:{board}:pairs", f"leaderboard:{board}:ready",
+            f"leaderboard:{board}:rebuild:jobs", f"leaderboard:{board}:rebuild:pairs", f"leaderboard:{board}:rebuilding",
+            f"leaderboard:{board}:rebuild:lock"
+        ]
+    
+    async def ready(self, board) -> bool:
+        """ Returns True if the leaderboard `board` has been built. """
+        return bool(await self._redis.exists(f"leaderboard:{board}:ready"))
+    
+    async def rebuild(self, board, load) -> bool:
+        """ Replaces the leaderboard `board` with the users returned by awaiting `load()`, a list of (nickname, jobs completed, pairs scraped) tuples.
+        Returns False if the board is already being rebuilt by another process, or if the rebuild outlived its lock and was abandoned. """
+        keys = self._keys(board)
+        token = f"{getpid()}:{uuid4().hex}"
+        if not await self._redis.set(keys[6], token, nx=True, ex=LEADERBOARD_REBUILD_TIMEOUT):
+            return False
+        
+        try:
+            if not await self._redis.eval(self._START_SCRIPT, len(keys), *keys, token, LEADERBOARD_REBUILD_TIMEOUT):
+                return False
+            
+            # The rebuilt board may already hold increments made since it was started, so the users are added to it rather than overwriting it.
+            users = await load()
+            for i in range(0, len(users), self._LOAD_BATCH_SIZE):
+                args = [value for nickname, jobs, pairs in users[i:i + self._LOAD_BATCH_SIZE] for value in (nickname, jobs, pairs or 0)]
+                if not await self._redis.eval(self._LOAD_SCRIPT, len(keys), *keys, token, *args):
+                    return False
+            
+            return bool(await self._redis.eval(self._REPLACE_SCRIPT, len(keys), *keys, token))
+        finally:
+            await self._redis.eval(_PageCache._RELEASE_LOCK_SCRIPT, 1, keys[6], token)
+    
+    async def total(self, board) -> int:
+        """ Returns the total number of jobs completed by the users on the leaderboard `board`. """
+        return int(await self._redis.eval(self._TOTAL_SCRIPT, 1, f"leaderboard:{board}:jobs"))
+    
+    async def incr(self, board, nickname, jobs, pairs=0) -> None:
+        """ Adds `jobs` completed jobs and `pairs` scraped pairs to the user `nickname` on the leaderboard `board`. """
+        keys = self._keys(board)[:6]
+        await self._redis.eval(self._INCR_SCRIPT, len(keys), *keys, nickname, jobs, pairs)
+    
+    async def page(self, board, start, count) -> List[dict]:
+        """ Returns `count` users from the leaderboard `board`, starting from rank `start` (0 = first place). """
+        users = await self._redis.zrevrange(f"leaderboard:{board}:jobs", start, start + count - 1, withscores=True)
+        if not users:
+            return []
+        
+        pairs = await self._redis.hmget(f"leaderboard:{board}:pairs", [nickname for nickname, _ in users])
+        return [
+            {"rank": start + i + 1, "nickname": nickname.decode(), "jobs_completed": int(jobs), "pairs_scraped": int(pairs[i] or 0)}
+            for i, (nickname, jobs) in enumerate(users)
+        ]
+    
+    async def length(self, board) -> int:
+        """ Returns the number of users on the leaderboard `board`. """
+        return await self._redis.zcard(f"leaderboard:{board}:jobs")
+    
+    async def rank(self, board, nickname) -> Optional[dict]:
+        """ Returns the rank and scores of the user `nickname` on the leaderboard `board`, or None if they are not on it. """
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.zrevrank(f"leaderboard:{board}:jobs", nickname)
+            pipe.zscore(f"leaderboard:{board}:jobs", nickname)
+            pipe.hget(f"leaderboard:{board}:pairs", nickname)
+            rank, jobs, pairs = await pipe.execute()
+        
+        if rank is None:
+            return None
+        return {"rank": rank + 1, "nickname": nickname, "jobs_completed": int(jobs), "pairs_scraped": int(pairs or 0)}
+
+
+class _Heartbeats:
+    def __init__(self, client: Redis):
+        """ A write-behind buffer of worker progress updates, periodically flushed to the database in a single batch. """
+        self._redis = client
+    
+    async def record(self, uuid, progress, last_seen) -> None:
+        """ Buffers the latest progress update `progress` of the client with UUID `uuid`, replacing any update not yet flushed. """
+        await self._redis.hset("heartbeats", uuid, json.dumps({"progress": progress, "last_seen": last_seen}))
+    
+    async def get(self, uuids) -> dict:
+        """ Returns the latest buffered progress update of each client in `uuids` which has not yet been flushed to the database. """
+        if not uuids:
+            return {}
+        
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.hmget("heartbeats:flushing", uuids)
+            pipe.hmget("heartbeats", uuids)
+            flushing, buffered = await pipe.execute()
+        
+        # Updates buffered since the current flush started are always newer than the ones being flushed.
+        heartbeats = {}
+        for uuid, *data in zip(uuids, flushing, buffered):
+            for heartbeat in data:
+                if heartbeat is not None:
+                    heartbeats[uuid] = json.loads(heartbeat)
+        return heartbeats
+    
+    async def take(self) -> dict:
+        """ Atomically moves every buffered update into the `heartbeats:flushing` hash and returns them, or returns the updates left behind by a failed flush. """
+        if not await self._redis.exists("heartbeats:flushing"):
+            if not await self._redis.exists("heartbeats"):
+                return {}
+            await self._redis.rename("heartbeats", "heartbeats:flushing")
+        
+        data = await self._redis.hgetall("heartbeats:flushing")
+        return {uuid.decode(): json.loads(heartbeat) for uuid, heartbeat in data.items()}
+    
+    async def flushed(self) -> None:
+        """ Discards the updates returned by `take` once they have been written to the database. """
+        await self._redis.delete("heartbeats:flushing")
+
+
+class _Tokens:
+    def __init__(self, client: Redis):
+        """ A cache of each worker's token, mapped to its type, display name, user nickname and current shard. """
+        self._redis = client
+        
+        # The type, display name and nickname of a worker never change, so they are also kept in a process-local LRU cache, which is
+        # invalidated when the worker is deleted. Entries also expire after `config.TOKEN_LOCAL_CACHE_EXPIRY` seconds, in case an invalidation is missed.
+        self._local = OrderedDict()
+    
+    def _set_local(self, uuid, client) -> None:
+        if not TOKEN_LOCAL_CACHE_SIZE:
+            return
+        
+        self._local[uuid] = ({key: client[key] for key in ("type", "display_name", "nickname")}, time() + TOKEN_LOCAL_CACHE_EXPIRY)
+        self._local.move_to_end(uuid)
+        
+        while len(self._local) > TOKEN_LOCAL_CACHE_SIZE:
+            self._local.popitem(last=False)
+    
+    async def set(self, uuid, type, display_name, nickname, shard=None) -> None:
+        """ Caches the details of the worker with token `uuid`. Expires after `config.IDLE_TIMEOUT` seconds, as idle workers are deleted after this. """
+        client = {"type": type, "display_name": display_name, "nickname": nickname}
+        
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hset(f"token:{uuid}", mapping={**client, "shard": "" if shard is None else shard})
+            pipe.expire(f"token:{uuid}", IDLE_TIMEOUT)
+            await pipe.execute()
+        
+        self._set_local(uuid, client)
+    
+    async def get(self, uuid) -> Optional[dict]:
+        """ Returns the type, display name and nickname of the worker with token `uuid`, or None if it is not cached. """
+        client, expires = self._local.get(uuid, (None, 0))
+        if client is not None:
+            if time() < expires:
+                self._local.move_to_end(uuid)
+                return client
+            del self._local[uuid]
+        
+        type, display_name, nickname = await self._redis.hmget(f"token:{uuid}", ["type", "display_name", "nickname"])
+        if type is None:
+            return None
+        
+        client = {"type": type.decode(), "display_name": display_name.decode(), "nickname": nickname.decode()}
+        self._set_local(uuid, client)
+        return client
+    
+    async def get_shard(self, uuid) -> Optional[int]:
+        """ Returns the shard number the worker with token `uuid` is currently working on, or None if it has no shard or is not cached. """
+        shard = await self._redis.hget(f"token:{uuid}", "shard")
+        return int(shard) if shard else None
+    
+    async def set_shard(self, uuids, shard) -> None:
+        """ Updates the current shard of every cached worker in `uuids` to `shard`. """
+        if not uuids:
+            return
+        
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for uuid in uuids:
+                pipe.hset(f"token:{uuid}", "shard", "" if shard is None else shard)
+            await pipe.execute()
+    
+    async def invalidate(self, uuids) -> None:
+        """ Removes every worker in `uuids` from the cache, and notifies every other process to drop their local copy. """
+        if not uuids:
+            return
+        
+        await self._redis.delete(*[f"token:{uuid}" for uuid in uuids])
+        for uuid in uuids:
+            self._local.pop(uuid, None)
+        
+        await self._redis.publish("token-invalidate", json.dumps(uuids))
+    
+    async def listen(self) -> None:
+        """ Drops workers from this process's local cache as soon as they are deleted by another process. """
+        while True:
+            try:
+                pubsub = self._redis.pubsub()
+                await pubsub.subscribe("token-invalidate")
+                
+                # Invalidations may have been missed whilst disconnected, so the local cache is dropped.
+                self._local.clear()
+                
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    
+                    for uuid in json.loads(message["data"]):
+                        self._local.pop(uuid, None)
+            except Exception:
+                await asyncio.sleep(5)
+
+
+class _Events:
+    def __init__(self, client: Redis):
+        """ Fans out the live dashboard events published by any process to every /events connection in this process. """
+        self._redis = client
+        self._subscribers = set()
+    
+    @staticmethod
+    def encode(event, data) -> bytes:
+        """ Returns the event `event` with the data `data`, encoded as a server-sent event. """
+        return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+    
+    async def publish(self, event, data) -> None:
+        """ Publishes the event `event` with the data `data` to every process. (the event is encoded once, and shared by every connection) """
+        await self._redis.publish("dashboard", self.encode(event, data))
+    
+    def subscribe(self) -> asyncio.Queue:
+        """ Returns a queue which receives every event published from now on, or None once it has been dropped for falling behind. """
+        queue = asyncio.Queue(maxsize=DASHBOARD_EVENT_QUEUE_SIZE)
+        self._subscribers.add(queue)
+        return queue
+    
+    def unsubscribe(self, queue) -> None:
+        """ Stops sending events to the queue `queue`. """
+        self._subscribers.discard(queue)
+    
+    async def listen(self) -> None:
+        """ Forwards every event published to the subscribers in this process. """
+        while True:
+            try:
+                pubsub = self._redis.pubsub()
+                await pubsub.subscribe("dashboard")
+                
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    
+                    for queue in list(self._subscribers):
+                        try:
+                            queue.put_nowait(message["data"])
+                        except asyncio.QueueFull:
+                            # The connection is closed, and the browser reconnects to receive a fresh snapshot.
+                            self.unsubscribe(queue)
+                            while not queue.empty():
+                                queue.get_nowait()
+                            queue.put_nowait(None)
+            except Exception:
+                await asyncio.sleep(5)
+
+
+class _Uploads:
+    # Picks the healthy address with the fewest workers assigned relative to its weight, and (re)assigns the worker to it in a single step.
+    # If every address has failed recently, the least loaded one is still handed out. The order of the addresses breaks ties.
+    # KEYS: the in-flight counts, the assignments, then the failures of each address. ARGV: now, worker UUID (or ""), address to avoid (or ""), then address/weight pairs.
+    _ASSIGN_SCRIPT = """
+    local now, uuid, avoid = tonumber(ARGV[1]), ARGV[2], ARGV[3]
+    local best, best_score, fallback, fallback_score
+    
+    for i = 4, #ARGV, 2 do
+        local address, weight = ARGV[i], tonumber(ARGV[i + 1])
+        local failures = KEYS[3 + (i - 4) / 2]
+        redis.call("ZREMRANGEBYSCORE", failures, "-inf", now - %d)
+        
+        local score = (tonumber(redis.call("HGET", KEYS[1], address) or "0") + 1) / weight
+        if address ~= avoid and redis.call("ZCARD", failures) < %d then
+            if best == nil or score < best_score then
+                best, best_score = address, score
+            end
+        elseif fallback == nil or score < fallback_score then
+            fallback, fallback_score = address, score
+        end
+    end
+    
+    local address = best or fallback
+    if uuid ~= "" then
+        local previous = redis.call("HGET", KEYS[2], uuid)
+        if previous then
+            redis.call("HINCRBY", KEYS[1], previous, -1)
+        end
+        redis.call("HSET", KEYS[2], uuid, address)
+        redis.call("HINCRBY", KEYS[1], address, 1)
+    end
+    return address
+    """ % (UPLOAD_FAILURE_WINDOW, UPLOAD_FAILURE_THRESHOLD)
+    
+    _RELEASE_SCRIPT = """
+    for i = 1, #ARGV do
+        local address = redis.call("HGET", KEYS[2], ARGV[i])
+        if address then
+            redis.call("HINCRBY", KEYS[1], address, -1)
+            redis.call("HDEL", KEYS[2], ARGV[i])
+        end
+    end
+    """
+    
+    # Recounts the number of workers assigned to each address from the assignments, correcting any releases which were missed.
+    _RECOUNT_SCRIPT = """
+    local assigned = redis.call("HVALS", KEYS[2])
+    local counts = {}
+    for _, address in ipairs(assigned) do
+        counts[address] = (counts[address] or 0) + 1
+    end
+    
+    redis.call("DEL", KEYS[1])
+    for address, count in pairs(counts) do
+        redis.call("HSET", KEYS[1], address, count)
+    end
+    return #assigned
+    """
+    
+    def __init__(self, client: Redis):
+        """ Balances workers across the upload addresses, tracking how many workers are assigned to each address and their recent upload failures. """
+        self._redis = client
+    
+    async def assign(self, addresses, uuid=None, avoid=None) -> str:
+        """ Returns the least loaded healthy address in `addresses`, assigning the worker with UUID `uuid` to it if given. (avoiding the address `avoid` if possible) """
+        addresses = list(addresses)
+        shuffle(addresses)
+        
+        weights = []
+        for address in addresses:
+            weights += [address, UPLOAD_ADDR_WEIGHTS.get(address, 1)]
+        
+        address = await self._redis.eval(
+            self._ASSIGN_SCRIPT, len(addresses) + 2, "uploads:inflight", "uploads:assigned", *[f"uploads:failures:{address}" for address in addresses],
+            int(time()), uuid or "", avoid or "", *weights
+        )
+        return address.decode()
+    
+    async def assigned(self, uuid) -> Optional[str]:
+        """ Returns the upload address the worker with UUID `uuid` is assigned to, or None if it is not assigned to one. """
+        address = await self._redis.hget("uploads:assigned", uuid)
+        return address.decode() if address is not None else None
+    
+    async def report_failure(self, address) -> None:
+        """ Records an upload failure to `address`, which counts against it for `config.UPLOAD_FAILURE_WINDOW` seconds. """
+        now = time()
+        await self._redis.zadd(f"uploads:failures:{address}", {f"{now}:{uuid4().hex}": now})
+    
+    async def release(self, uuids) -> None:
+        """ Unassigns the workers in `uuids` from their upload addresses. """
+        if uuids:
+            await self._redis.eval(self._RELEASE_SCRIPT, 2, "uploads:inflight", "uploads:assigned", *uuids)
+    
+    async def assignments(self) -> dict:
+        """ Returns the upload address every assigned worker is assigned to, by UUID. """
+        return {uuid.decode(): address.decode() for uuid, address in (await self._redis.hgetall("uploads:assigned")).items()}
+    
+    async def recount(self) -> None:
+        """ Atomically recounts the number of workers assigned to each upload address. """
+        await self._redis.eval(self._RECOUNT_SCRIPT, 2, "uploads:inflight", "uploads:assigned")
+    
+    async def loads(self) -> dict:
+        """ Returns the number of workers assigned to each upload address. """
+        return {address.decode(): int(count) for address, count in (await self._redis.hgetall("uploads:inflight")).items()}
+
+
+class _LeaderLease:
+    # Only extends/releases the lease if it is still held by this process, as it may have expired and been taken by another.
+    _RENEW_SCRIPT = """
+    if redis.call("GET", KEYS[1]) == ARGV[1] then
+        return redis.call("EXPIRE", KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    _RELEASE_SCRIPT = """
+    if redis.call("GET", KEYS[1]) == ARGV[1] then
+        return redis.call("DEL", KEYS[1])
+    end
+    return 0
+    """
+    
+    def __init__(self, client: Redis):
+        """ A lease on the Redis `leader` key, electing a single process (the zero worker) to run the background tasks. """
+        self._redis = client
+        self.id = f"{gethostname()}:{getpid()}:{uuid4().hex}"
+        self.is_leader = False
+    
+    async def acquire(self) -> bool:
+        """ Returns True if this process holds the lease, taking it if it is free or extending it if already held. Expires after `config.LEADER_LEASE_TIMEOUT` seconds. """
+        if await self._redis.set("leader", self.id, nx=True, ex=LEADER_LEASE_TIMEOUT):
+            return True
+        return bool(await self._redis.eval(self._RENEW_SCRIPT, 1, "leader", self.id, LEADER_LEASE_TIMEOUT))
+    
+    async def release(self) -> None:
+        """ Releases the lease if held by this process, allowing another process to take over immediately. """
+        await self._redis.eval(self._RELEASE_SCRIPT, 1, "leader", self.id)
+    
+    async def run(self, on_elected, on_deposed) -> None:
+        """ Heartbeats the lease every `config.LEADER_HEARTBEAT_INTERVAL` seconds, calling `on_elected` when this process becomes the leader and `on_deposed` when it stops being the leader. """
+        while True:
+            try:
+                held = await self.acquire()
+            except Exception:
+                # Step down if Redis is unreachable, as the lease may expire and be taken by another process in the meantime.
+                held = False
+            
+            if held != self.is_leader:
+                self.is_leader = held
+                if held:
+                    on_elected()
+                else:
+                    on_deposed()
+            
+            await asyncio.sleep(LEADER_HEARTBEAT_INTERVAL)
 
 
 class Cache:
     def __init__(self, connection_url: str):
-        """ Creates the Redis client instance as well as a `_PageCache` instance for caching webpages. """
+        """ Creates the Redis client instance, a `_PageCache` instance for caching webpages, a `_JobQueue` instance for jobs reserved in advance, a `_Counters` instance for live job/client counts, a `_Heartbeats` instance for buffering progress updates, a `_Tokens` instance for validating workers, a `_Leaderboards` instance for ranking users, an `_Events` instance for the live dashboard, an `_Uploads` instance for balancing upload addresses, and a `_LeaderLease` instance for electing the zero worker. """
         self.client = from_url(connection_url)
         self.page = _PageCache(self.client)
+        self.queue = _JobQueue(self.client)
+        self.counters = _Counters(self.client)
+        self.heartbeats = _Heartbeats(self.client)
+        self.tokens = _Tokens(self.client)
+        self.leaderboards = _Leaderboards(self.client)
+        self.events = _Events(self.client)
+        self.uploads = _Uploads(self.client)
+        self.leader = _LeaderLease(self.client)
     
     
-    async def initPID(self, sleep: bool = True) -> None:
-        """ Gets the current process ID, and pushes it to the Redis `workers` list. """
-        pid = getpid()
-        await self.client.rpush("workers", pid)
-        
-        if sleep:
-            await asyncio.sleep(0.25)
-            
-        data = await self.client.lrange("workers", 0, 0)
-        self.iszeroworker = (pid == int(data[0]))
+    @property
+    def iszeroworker(self) -> bool:
+        """ Returns True if this process currently holds the leader lease. """
+        return self.leader.is_leader
     
     
     async def safeShutdown(self) -> None:
-        """ [IMPORTANT] Resets the workers list to allow the server to
-                                        safely turn back on again. """
-        await self.client.delete("workers")
+        """ Releases the leader lease, allowing another process to take over the background tasks straight away. """
+        if self.leader.is_leader:
+            await self.leader.release()
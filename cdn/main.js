@@ -63,12 +63,132 @@ function timeDifference(current, previous) {
     }
 }
 
-$(document).ready(function() {
-    var current = Math.floor(Date.now() / 1000);
+function formatCount(value) {
+    return typeof value === 'number' ? value.toLocaleString('en-US') : value;
+}
+
+function setTimestamp(cell, time) {
+    cell.attr('data-time', time).text(timeDifference(Math.floor(Date.now() / 1000), time));
+}
+
+function findWorkerRow(type, name) {
+    return $('#workers-' + type.toLowerCase() + ' tr').filter(function() {
+        return $(this).attr('data-worker') === name;
+    });
+}
+
+function addWorkerRow(tbody, type, worker) {
+    var row = $('<tr>').attr('data-worker', worker.display_name);
+    var link = $('<a>').attr('href', '/worker/' + type.toLowerCase() + '/' + encodeURIComponent(worker.display_name)).text(worker.display_name);
+    row.append($('<th scope="row">').append(link));
+
+    if (worker.shard_number === null) {
+        row.append($('<td>').append($('<i>').text('Waiting')));
+    } else {
+        row.append($('<td>').text(worker.shard_number.toLocaleString('en-US')));
+    }
+
+    row.append($('<td class="worker-progress">').text(worker.progress));
+    row.append($('<td>').text(worker.jobs_completed.toLocaleString('en-US')));
+    row.append($('<td>').text(worker.user_nickname));
+
+    var timestamp = $('<td class="timestamp">');
+    setTimestamp(timestamp, worker.last_seen);
+    row.append(timestamp);
+    tbody.append(row);
+}
+
+// Applies the events pushed from /events to the dashboard, instead of reloading the page.
+function listenForEvents() {
+    var events = new EventSource('/events');
+
+    // Only the stats which changed are sent, apart from the first event after connecting.
+    events.addEventListener('stats', function(e) {
+        var stats = JSON.parse(e.data);
+
+        if ('completion_float' in stats) {
+            $('#completion-float').text(stats.completion_float.toFixed(2));
+            $('#completion-bar').css('width', stats.completion_float + '%').attr('aria-valuenow', stats.completion_float);
+        }
+        if ('completion_str' in stats) $('#completion-str').text(stats.completion_str);
+        if ('total_pairs' in stats) $('#total-pairs').text(formatCount(stats.total_pairs));
+        if ('total_multilanguage_pairs' in stats) $('#total-multilanguage-pairs').text(formatCount(stats.total_multilanguage_pairs));
+        if ('total_nolang_pairs' in stats) $('#total-nolang-pairs').text(formatCount(stats.total_nolang_pairs));
+        if ('eta' in stats) $('#eta').text(stats.eta);
+
+        $.each(['hybrid', 'cpu', 'gpu'], function(i, type) {
+            if (('len_' + type) in stats) $('#len-' + type).text(formatCount(stats['len_' + type]));
+        })
+    })
+
+    // New workers are only added once every worker before them has been loaded, as the tables are in order of connection.
+    events.addEventListener('join', function(e) {
+        var worker = JSON.parse(e.data);
+        var tbody = $('#workers-' + worker.type.toLowerCase());
 
+        if (tbody.length && !$('.load-workers[data-type="' + worker.type + '"]').length) {
+            addWorkerRow(tbody, worker.type, worker);
+        }
+    })
+
+    events.addEventListener('leave', function(e) {
+        $.each(JSON.parse(e.data), function(i, worker) {
+            findWorkerRow(worker.type, worker.display_name).remove();
+        })
+    })
+
+    events.addEventListener('progress', function(e) {
+        $.each(JSON.parse(e.data), function(i, worker) {
+            var row = findWorkerRow(worker.type, worker.display_name);
+            row.find('.worker-progress').text(worker.progress);
+            setTimestamp(row.find('.timestamp'), worker.last_seen);
+        })
+    })
+}
+
+$(document).ready(function() {
     $('.timestamp').each(function() {
-        var prev = parseInt($(this).text());
-        var diff = timeDifference(current, prev);
-        $(this).text(diff);
+        setTimestamp($(this), parseInt($(this).text()));
+    })
+
+    // Keeps the relative "last seen" times current.
+    setInterval(function() {
+        $('.timestamp').each(function() {
+            setTimestamp($(this), parseInt($(this).attr('data-time')));
+        })
+    }, 10000)
+
+    // Only the dashboard receives live updates. (falling back to reloading the page if they are not supported)
+    if ($('#completion-str').length) {
+        if (window.EventSource) {
+            listenForEvents();
+        } else {
+            setTimeout(function() {
+                location.reload();
+            }, 30000)
+        }
+    }
+
+    // Loads the next page of workers from /api/workers into the table above the button.
+    $('.load-workers').click(function() {
+        var button = $(this);
+        var type = button.data('type');
+        button.prop('disabled', true);
+
+        $.getJSON('/api/workers', {type: type, after: button.data('after'), skip: button.data('skip')}, function(data) {
+            var tbody = $('#workers-' + type.toLowerCase());
+
+            $.each(data.workers, function(i, worker) {
+                addWorkerRow(tbody, type, worker);
+            })
+
+            if (data.next === null) {
+                button.remove();
+            } else {
+                button.data('after', data.next.after).data('skip', data.next.skip).prop('disabled', false);
+            }
+        }).fail(function() {
+            button.prop('disabled', false);
+        })
     })
 })
@@ -6,16 +6,56 @@ REDIS_CONN_URL = "redis://127.0.0.1" # The Redis connection URL, used for cachin
 
 # WORKER CONFIG
 IDLE_TIMEOUT = 7200 # The interval, in seconds, until a worker is kicked for being idle. (default 2 hours)
+IDLE_CHECK_INTERVAL = 300 # The interval, in seconds, between each check for idle workers. (default 5 minutes)
+JOB_LEASE_TIMEOUT = 1800 # The number of seconds a worker can go without reporting progress before its job is returned to the pool. (default 30 minutes)
+JOB_LEASE_SWEEP_INTERVAL = 30 # The interval, in seconds, between each check for jobs with expired leases.
+TOKEN_LOCAL_CACHE_SIZE = 10000 # The maximum number of worker tokens each process keeps in memory in front of the Redis token cache. (0 disables it)
+TOKEN_LOCAL_CACHE_EXPIRY = 30 # The number of seconds each process keeps a worker token in memory before checking it against Redis again.
+HEARTBEAT_FLUSH_INTERVAL = 5 # The interval, in seconds, between each batched write of worker progress updates from Redis to the database.
+MAX_BULK_JOBS = 100 # The maximum number of jobs a worker can claim in a single /api/newJobs request.
+
+# JOB QUEUE
+JOB_QUEUE_SIZE = 500 # The number of open jobs of each type reserved in advance in Redis, allowing /api/newJob to avoid the database.
+JOB_QUEUE_REFILL_INTERVAL = 5 # The interval, in seconds, between each refill of the job queues.
+JOB_QUEUE_TIMEOUT = 600 # The number of seconds a reserved job can sit unused in a queue until it is returned to the pool. (default 10 minutes)
+
+# LIVE COUNTERS
+COUNTER_RECONCILE_INTERVAL = 600 # The interval, in seconds, between each recount of the live job/client counters from the database. (default 10 minutes)
+
+# LEADER ELECTION
+LEADER_LEASE_TIMEOUT = 10 # The number of seconds until the leader lease expires if not renewed, after which another worker takes over the background tasks.
+LEADER_HEARTBEAT_INTERVAL = 3 # The interval, in seconds, between each renewal of the leader lease. (must be less than LEADER_LEASE_TIMEOUT)
 
 # ETA CALCULATION
 AVERAGE_INTERVAL = 900 # The interval for each measurement of the averages to take place. (default 15 minutes)
 AVERAGE_DATASET_LENGTH = 10 # The maximum amount of measurements for the averages until older measurements are discarded.
 
+# PAIRS COUNT
+NOLANG_PAIRS_URL = "http://116.202.162.146:8000/info/?key=nolang" # The URL polled for the number of pairs scraped without a language. (nl-pairs)
+PAIRS_POLL_INTERVAL = 25 # The interval, in seconds, between each poll of NOLANG_PAIRS_URL.
+PAIRS_POLL_TIMEOUT = 10 # The number of seconds until a poll of NOLANG_PAIRS_URL times out.
+PAIRS_POLL_MAX_BACKOFF = 600 # The maximum interval, in seconds, between polls whilst NOLANG_PAIRS_URL is unavailable. (doubles after each failed poll)
+
+# LIVE DASHBOARD
+DASHBOARD_EVENT_INTERVAL = 2 # The interval, in seconds, between each check for changes to the dashboard stats sent to /events.
+DASHBOARD_KEEPALIVE_INTERVAL = 15 # The number of seconds without any events until a keep-alive comment is sent to each /events connection.
+DASHBOARD_EVENT_QUEUE_SIZE = 100 # The maximum number of events buffered for each /events connection, after which a slow connection is dropped. (browsers then reconnect)
+
+# METRICS
+METRICS_FLUSH_INTERVAL = 5 # The interval, in seconds, between each process adding its request metrics to the shared metrics in Redis. (served at /metrics)
+
 # ADMIN
 ADMIN_PASSWORD = "password"
 
 # CACHE
 PAGE_CACHE_EXPIRY = 30 # The number of seconds until the page cache is cleared and the page is re-rendered. (avoids database strain)
+PAGE_RENDER_LOCK_TIMEOUT = 10 # The maximum number of seconds a single process can hold the lock for re-rendering an expired page.
+LEADERBOARD_REBUILD_TIMEOUT = 300 # The maximum number of seconds a single process can hold the lock for rebuilding a leaderboard from the database.
+PAGE_LOCAL_CACHE_SIZE = 16 # The maximum number of pages each process keeps in memory in front of the Redis page cache.
+LEADERBOARD_PAGE_SIZE = 100 # The number of users shown on each page of the leaderboard.
+WORKER_LIST_PAGE_SIZE = 50 # The number of workers of each type shown on the dashboard, and loaded each time "Load more" is clicked.
+WORKER_LIST_MAX_PAGE_SIZE = 500 # The maximum number of workers returned by a single request to /api/workers.
+PAGE_CACHE_PREWARM = False # Whether the zero worker should re-render the most visited pages in the background before they expire.
 
 # UPLOAD ADDRESSES
 UPLOAD_ADDRS = [
@@ -24,3 +64,6 @@ UPLOAD_ADDRS = [
 UPLOAD_CPU_ADDRS = [
     "archiveteam@5.9.55.230::gpujobs"
 ]
+UPLOAD_ADDR_WEIGHTS = {} # The relative capacity of each upload address, e.g. {"archiveteam@88.198.2.17::CAH": 2}. (default 1)
+UPLOAD_FAILURE_WINDOW = 300 # The number of seconds an upload failure reported by a worker counts against an upload address.
+UPLOAD_FAILURE_THRESHOLD = 3 # The number of recent upload failures after which an upload address is avoided until they expire. (unless every address is failing)
@@ -1,29 +1,33 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import HTMLResponse, PlainTextResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 
 import asyncio
-from typing import Optional
+from typing import List, Optional
 from pydantic import BaseModel
 from tortoise.transactions import in_transaction
+from tortoise.expressions import F
 from tortoise.contrib.fastapi import register_tortoise
+from tortoise import Tortoise
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
 from name import new as new_name
-from random import choice
-from requests import get
+from random import choice, randint, shuffle
 from uuid import uuid4
-from time import time
+from time import time, perf_counter
 import aiofiles
+import httpx
 import json
 
 from config import *
 from models import *
-from cache import Cache
+from cache import Cache, brotli
+from metrics import Metrics
 
     
 app = FastAPI()
 cache = Cache(REDIS_CONN_URL)
+metrics = Metrics(cache.client)
 templates = Jinja2Templates(directory="templates")
 
 types = ["HYBRID", "CPU", "GPU"]
@@ -35,6 +39,8 @@ types = ["HYBRID", "CPU", "GPU"]
 class TokenInput(BaseModel):
     token: str
     type: Optional[str] = "HYBRID"
+    
+    count: Optional[int] = 1  # The number of jobs to claim. (/api/newJobs only)
 
 class TokenProgressInput(BaseModel):
     token: str
@@ -52,6 +58,21 @@ class TokenCountInput(BaseModel): # For marking as done
     end_id: Optional[str] = None
     shard: Optional[int] = None
 
+class JobResultInput(BaseModel): # A single job in a bulk markAsDone
+    number: int
+    count: Optional[int] = None  # `count` is for HYBRID/GPU
+    url: Optional[str] = None    # `url` is for CPU
+
+class TokenJobsInput(BaseModel): # For marking multiple jobs as done
+    token: str
+    type: Optional[str] = "HYBRID"
+    jobs: List[JobResultInput]
+
+class UploadFailedInput(BaseModel):
+    token: str
+    type: Optional[str] = "HYBRID"
+    address: Optional[str] = None # (defaults to the address the worker is assigned to)
+
 class BanShardCountInput(BaseModel):
     password: str
     count: int
@@ -78,90 +99,219 @@ class IsCompleteInput(BaseModel):
 # FRONTEND START ------
 
 
-@app.get('/', response_class=HTMLResponse)
-async def index(request: Request, all: Optional[bool] = False):
-    try:
-        body, expired = await cache.page.get_body_expired(f'/?all={all}')
-        if not expired:
-            return HTMLResponse(content=body)
-        else:
-            # Cache has expired, we need to re-render the page body.
-            pass
-    except:
-        # Cache hasn't yet been set, we need to render the page body.
-        pass
+async def _get_cached_page(page, render):
+    """ Returns the entry for page `page` from the page cache, using `render` to re-render it once it has expired. """
+    labels = {"page": page.partition("?")[0]}
     
-    # Render body
+    entry = await cache.page.get(page)
+    if entry is not None and not entry.expired:
+        metrics.incr("crawlingathome_page_cache_total", {**labels, "result": "hit"})
+        return entry
     
-    completed = await Job.filter(closed=True).count()
-    total = await Job.all().count()
+    # Only a single process re-renders an expired page, whilst every other process continues to serve the stale body.
+    lock = await cache.page.acquire_lock(page)
+    if lock is not None:
+        metrics.incr("crawlingathome_page_cache_total", {**labels, "result": "miss"})
+        try:
+            entry = await cache.page.set(page, await render())
+        finally:
+            await cache.page.release_lock(page, lock)
+        return entry
+    elif entry is not None:
+        metrics.incr("crawlingathome_page_cache_total", {**labels, "result": "stale"})
+        return entry
     
-    banner = await cache.client.get("banner")
-
-    if not all:
-        hybrid_clients = await Client.filter(type="HYBRID").prefetch_related("shard").order_by("first_seen").limit(50)
-        cpu_clients = await Client.filter(type="CPU").prefetch_related("shard").order_by("first_seen").limit(50)
-        gpu_clients = await Client.filter(type="GPU").prefetch_related("shard").order_by("first_seen").limit(50)
-    else:
-        hybrid_clients = await Client.filter(type="HYBRID").prefetch_related("shard").order_by("first_seen")
-        cpu_clients = await Client.filter(type="CPU").prefetch_related("shard").order_by("first_seen")
-        gpu_clients = await Client.filter(type="GPU").prefetch_related("shard").order_by("first_seen")
+    metrics.incr("crawlingathome_page_cache_total", {**labels, "result": "miss"})
+    # The page has never been cached, so we wait for the process holding the lock to render it.
+    for _ in range(PAGE_RENDER_LOCK_TIMEOUT * 10):
+        await asyncio.sleep(0.1)
+        entry = await cache.page.get(page)
+        if entry is not None:
+            return entry
     
-    len_hybrid = await Client.filter(type="HYBRID").count()
-    len_cpu = await Client.filter(type="CPU").count()
-    len_gpu = await Client.filter(type="GPU").count()
+    return await cache.page.set(page, await render())
+
+
+def _page_response(request, entry, media_type):
+    """ Returns a response containing the page entry `entry`, compressed using the best encoding accepted by the client, or a 304 if the client already has it. """
+    headers = {"Vary": "Accept-Encoding", "ETag": entry.etag, "Cache-Control": "no-cache"}
     
-    total_pairs = await cache.client.get("pairs")
-    total_ml_pairs = await cache.client.get("ml-pairs")
-    total_nl_pairs = await cache.client.get("nl-pairs")
+    etags = [etag.strip() for etag in request.headers.get("if-none-match", "").split(",")]
+    if entry.etag in etags or entry.etag[2:] in etags or "*" in etags:
+        return Response(status_code=304, headers=headers)
     
-    if not total_pairs:
-        total_pairs = "N/A"
-    else:
+    accepted = set()
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.partition(";")
         try:
-            total_pairs = int(total_pairs)
+            if params.strip().startswith("q=") and float(params.strip()[2:]) == 0:
+                continue
         except ValueError:
-            total_pairs = total_pairs.decode()
+            continue
+        accepted.add(name.strip().lower())
     
-    if not total_ml_pairs:
-        total_ml_pairs = "N/A"
+    if "br" in accepted and brotli is not None:
+        encoding = "br"
+    elif "gzip" in accepted:
+        encoding = "gzip"
     else:
-        try:
-            total_ml_pairs = int(total_ml_pairs)
-        except ValueError:
-            total_ml_pairs = total_ml_pairs.decode()
+        encoding = None
     
-    if not total_nl_pairs:
-        total_nl_pairs = "N/A"
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    
+    return Response(content=entry.encoded(encoding), media_type=media_type, headers=headers)
+
+
+async def _get_pairs(key):
+    """ Returns the pairs count stored at `key`, or "N/A" if it has not been set. """
+    pairs = await cache.client.get(key)
+    
+    if not pairs:
+        return "N/A"
     else:
         try:
-            total_nl_pairs = int(total_nl_pairs)
+            return int(pairs)
         except ValueError:
-            total_nl_pairs = total_nl_pairs.decode()
-        
+            return pairs.decode()
+
+
+async def _overlay_heartbeats(clients):
+    """ Replaces the progress and last seen time of each client in `clients` with any newer update not yet flushed to the database. """
+    heartbeats = await cache.heartbeats.get([client.uuid for client in clients])
+    for client in clients:
+        heartbeat = heartbeats.get(client.uuid)
+        if heartbeat is not None and heartbeat["last_seen"] >= client.last_seen:
+            client.progress = heartbeat["progress"]
+            client.last_seen = heartbeat["last_seen"]
+
+
+async def _list_workers(type, after=0, skip=0, limit=WORKER_LIST_PAGE_SIZE):
+    """ Returns a page of up to `limit` workers of type `type` in order of connection, along with the cursor of the next page. (or None if this is the last page) """
+    # Workers are ordered by (first_seen, uuid), and the cursor is the last first_seen seen with the number of workers already seen with it.
+    # The UUID itself is never part of the cursor, as it is the worker's token. Only workers connecting in the same second are ever skipped.
+    workers = await Client.filter(type=type, first_seen__gte=after).order_by("first_seen", "uuid").offset(skip).limit(limit).values(
+        "uuid", "display_name", "shard_id", "progress", "jobs_completed", "user_nickname", "first_seen", "last_seen"
+    )
+    
+    heartbeats = await cache.heartbeats.get([worker["uuid"] for worker in workers])
+    for worker in workers:
+        heartbeat = heartbeats.pop(worker.pop("uuid"), None)
+        if heartbeat is not None and heartbeat["last_seen"] >= worker["last_seen"]:
+            worker["progress"] = heartbeat["progress"]
+            worker["last_seen"] = heartbeat["last_seen"]
         
-    body = templates.TemplateResponse('index.html', {
-        "request": request,
-        "all": all,
+        # The shard ID is the shard number.
+        worker["shard_number"] = worker.pop("shard_id")
+    
+    if len(workers) < limit:
+        return workers, None
+    
+    last = workers[-1]["first_seen"]
+    seen = sum(worker["first_seen"] == last for worker in workers)
+    return workers, {"after": last, "skip": seen + skip if last == after else seen}
+
+
+async def _render_index():
+    counts = await cache.counters.get_all()
+    completed = counts["closed"]
+    total = sum(counts[state] for state in cache.counters.JOB_STATES)
+    
+    banner = await cache.client.get("banner")
+    
+    hybrid_clients, hybrid_next = await _list_workers("HYBRID")
+    cpu_clients, cpu_next = await _list_workers("CPU")
+    gpu_clients, gpu_next = await _list_workers("GPU")
+    
+    return templates.get_template('index.html').render({
         "banner": banner,
         "hybrid_clients": hybrid_clients,
         "cpu_clients": cpu_clients,
         "gpu_clients": gpu_clients,
-        "len_hybrid": len_hybrid,
-        "len_cpu": len_cpu,
-        "len_gpu": len_gpu,
+        "hybrid_next": hybrid_next,
+        "cpu_next": cpu_next,
+        "gpu_next": gpu_next,
+        "len_hybrid": counts["clients:HYBRID"],
+        "len_cpu": counts["clients:CPU"],
+        "len_gpu": counts["clients:GPU"],
         "completion_float": (completed / total) * 100 if total > 0 else 100.0,
         "completion_str": f"{completed:,} / {total:,}",
-        "total_pairs": total_pairs,
-        "total_multilanguage_pairs": total_ml_pairs,
-        "total_nolang_pairs": total_nl_pairs,
+        "total_pairs": await _get_pairs("pairs"),
+        "total_multilanguage_pairs": await _get_pairs("ml-pairs"),
+        "total_nolang_pairs": await _get_pairs("nl-pairs"),
+        "eta": (await cache.client.get("eta")).decode()
+    })
+
+
+async def _leaderboard_users(board):
+    """ Returns every user on the leaderboard `board` from the database, as (nickname, jobs completed, pairs scraped) tuples. """
+    if board == "cpu":
+        return [(nickname, jobs, 0) for nickname, jobs in await CPU_Leaderboard.all().values_list("nickname", "jobs_completed")]
+    else:
+        return await Leaderboard.all().values_list("nickname", "jobs_completed", "pairs_scraped")
+
+
+async def _rebuild_leaderboard(board):
+    """ Rebuilds the leaderboard `board` from the database, returning False if it is already being rebuilt by another process. """
+    return await cache.leaderboards.rebuild(board, lambda: _leaderboard_users(board))
+
+
+async def _get_leaderboard(board):
+    """ Returns the leaderboard `board`, rebuilding it from the database if it is missing from the cache. """
+    if await cache.leaderboards.ready(board) or await _rebuild_leaderboard(board):
+        return board
+    
+    # The leaderboard is being rebuilt by another process, so we wait for it to finish.
+    for _ in range(PAGE_RENDER_LOCK_TIMEOUT * 10):
+        await asyncio.sleep(0.1)
+        if await cache.leaderboards.ready(board):
+            return board
+    
+    raise HTTPException(status_code=503, detail="The leaderboard is being rebuilt - try again shortly.")
+
+
+async def _render_leaderboard(page):
+    start = (page - 1) * LEADERBOARD_PAGE_SIZE
+    leaderboard = await cache.leaderboards.page(await _get_leaderboard("gpu"), start, LEADERBOARD_PAGE_SIZE)
+    cpu_leaderboard = await cache.leaderboards.page(await _get_leaderboard("cpu"), start, LEADERBOARD_PAGE_SIZE)
+    users = max(await cache.leaderboards.length("gpu"), await cache.leaderboards.length("cpu"))
+    
+    return templates.get_template('leaderboard.html').render({
+        "banner": await cache.client.get("banner"),
+        "leaderboard": leaderboard,
+        "cpu_leaderboard": cpu_leaderboard,
+        "page": page,
+        "has_next": start + LEADERBOARD_PAGE_SIZE < users
+    })
+
+
+async def _render_data():
+    counts = await cache.counters.get_all()
+    completed = counts["closed"]
+    total = sum(counts[state] for state in cache.counters.JOB_STATES)
+    
+    return json.dumps({
+        "completion_str": f"{completed:,} / {total:,}",
+        "completion_float": (completed / total) * 100 if total > 0 else 100.0,
+        "total_connected_workers": sum(counts[f"clients:{type}"] for type in cache.counters.CLIENT_TYPES),
+        "total_pairs_scraped": await _get_pairs("pairs"),
+        "total_multilanguage_pairs_scraped": await _get_pairs("ml-pairs"),
         "eta": (await cache.client.get("eta")).decode()
     })
 
-    # Set page cache with body.
-    await cache.page.set(f'/?all={all}', body.body)
 
-    return body
+# The pages re-rendered in the background by `prewarm_pages`.
+PREWARMED_PAGES = {
+    "/": _render_index,
+    "/leaderboard?page=1": lambda: _render_leaderboard(1),
+    "/data": _render_data
+}
+
+
+@app.get('/', response_class=HTMLResponse)
+async def index(request: Request):
+    entry = await _get_cached_page('/', _render_index)
+    return _page_response(request, entry, "text/html")
     
 
 
@@ -176,31 +326,54 @@ async def install(request: Request):
 
 
 @app.get('/leaderboard', response_class=HTMLResponse)
-async def leaderboard_page(request: Request):
-    try:
-        body, expired = await cache.page.get_body_expired('/leaderboard')
-        if not expired:
-            return HTMLResponse(content=body)
-        else:
-            # Cache has expired, we need to re-render the page body.
-            pass
-    except:
-        # Cache hasn't yet been set, we need to render the page body.
-        pass
+async def leaderboard_page(request: Request, page: Optional[int] = 1):
+    if page < 1:
+        raise HTTPException(status_code=400, detail="The page number must be at least 1.")
     
-    banner = await cache.client.get("banner")
+    if page > 1:
+        # Pages past the end of the leaderboards show the last page, so only real pages are ever cached.
+        users = max([await cache.leaderboards.length(await _get_leaderboard(board)) for board in ["gpu", "cpu"]])
+        page = min(page, max(-(-users // LEADERBOARD_PAGE_SIZE), 1))
     
-    body = templates.TemplateResponse('leaderboard.html', {
-        "request": request,
-        "banner": banner,
-        "leaderboard": await Leaderboard.all().order_by("-jobs_completed"),
-        "cpu_leaderboard": await CPU_Leaderboard.all().order_by("-jobs_completed")
-    })
+    entry = await _get_cached_page(f'/leaderboard?page={page}', lambda: _render_leaderboard(page))
+    return _page_response(request, entry, "text/html")
+
+
+@app.get('/api/leaderboardRank')
+async def leaderboardRank(nickname: str, type: Optional[str] = "GPU"):
+    if type not in types:
+        raise HTTPException(status_code=400, detail=f"Invalid worker type. Choose from: {types}.")
+    
+    # Hybrid and GPU workers share the same leaderboard.
+    rank = await cache.leaderboards.rank(await _get_leaderboard("cpu" if type == "CPU" else "gpu"), nickname)
+    if rank is None:
+        raise HTTPException(status_code=404, detail="This user is not on the leaderboard.")
     
-    # Set page cache with body.
-    await cache.page.set('/leaderboard', body.body)
+    return rank
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics_page():
+    await metrics.flush()
+    
+    counts = await cache.counters.get_all()
+    gauges = {f'crawlingathome_jobs{{state="{state}"}}': counts[state] for state in cache.counters.JOB_STATES}
+    gauges.update({f'crawlingathome_clients{{type="{type}"}}': counts[f"clients:{type}"] for type in cache.counters.CLIENT_TYPES})
+    gauges.update({f'crawlingathome_upload_workers{{address="{address}"}}': count for address, count in (await cache.uploads.loads()).items()})
+    
+    return PlainTextResponse(await metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
+
+@app.get('/api/workers')
+async def workers(type: str, after: Optional[int] = 0, skip: Optional[int] = 0, limit: Optional[int] = WORKER_LIST_PAGE_SIZE):
+    type = type.upper()
+    if type not in types:
+        raise HTTPException(status_code=400, detail=f"Invalid worker type. Choose from: {types}.")
+    if skip < 0 or not 1 <= limit <= WORKER_LIST_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"The page size must be between 1 and {WORKER_LIST_MAX_PAGE_SIZE}.")
     
-    return body
+    workers, next = await _list_workers(type, after, skip, limit)
+    return {"workers": workers, "next": next}
 
 
 @app.get('/worker/{type}/{display_name}', response_class=HTMLResponse)
@@ -216,58 +389,61 @@ async def worker_info(type: str, display_name: str, request: Request):
     except:
         raise HTTPException(status_code=404, detail="Worker not found.")
     
+    await _overlay_heartbeats([data])
+    
     return templates.TemplateResponse('worker.html', {"request": request, "c": data, "banner": banner})
 
 
 @app.get('/data')
-async def data():
-    try:
-        body, expired = await cache.page.get_body_expired('/data')
-        if not expired:
-            return json.loads(body)
-        else:
-            # Cache has expired, we need to re-render the page body.
-            pass
-    except:
-        # Cache hasn't yet been set, we need to render the page body.
-        pass
-    
-    
-    total_pairs = await cache.client.get("pairs")
-    total_ml_pairs = await cache.client.get("ml-pairs")
-    
-    if not total_pairs:
-        total_pairs = "N/A"
-    else:
-        try:
-            total_pairs = int(total_pairs)
-        except ValueError:
-            total_pairs = total_pairs.decode()
-    
-    if not total_ml_pairs:
-        total_ml_pairs = "N/A"
-    else:
-        try:
-            total_ml_pairs = int(total_ml_pairs)
-        except ValueError:
-            total_ml_pairs = total_ml_pairs.decode()
-    
+async def data(request: Request):
+    entry = await _get_cached_page('/data', _render_data)
+    return _page_response(request, entry, "application/json")
+
+
+async def _dashboard_stats():
+    """ Returns the stats shown on the dashboard, which are sent to the live dashboard. (only read from Redis) """
+    counts = await cache.counters.get_all()
+    completed = counts["closed"]
+    total = sum(counts[state] for state in cache.counters.JOB_STATES)
+    eta = await cache.client.get("eta")
     
-    completed = await Job.filter(closed=True).count()
-    total = await Job.all().count()
-    body = {
+    return {
         "completion_str": f"{completed:,} / {total:,}",
         "completion_float": (completed / total) * 100 if total > 0 else 100.0,
-        "total_connected_workers": await Client.all().count(),
-        "total_pairs_scraped": total_pairs,
-        "total_multilanguage_pairs_scraped": total_ml_pairs,
-        "eta": (await cache.client.get("eta")).decode()
+        "len_hybrid": counts["clients:HYBRID"],
+        "len_cpu": counts["clients:CPU"],
+        "len_gpu": counts["clients:GPU"],
+        "total_pairs": await _get_pairs("pairs"),
+        "total_multilanguage_pairs": await _get_pairs("ml-pairs"),
+        "total_nolang_pairs": await _get_pairs("nl-pairs"),
+        "eta": eta.decode() if eta else "N/A"
     }
+
+
+@app.get('/events')
+async def events(request: Request):
+    # Events are published once through Redis and fanned out to every connection, so connections never touch the database.
+    queue = cache.events.subscribe()
     
-    # Set page cache with body.
-    await cache.page.set('/data', json.dumps(body))
+    async def stream():
+        try:
+            # A snapshot of the stats is sent first, so the dashboard is up to date after (re)connecting.
+            yield cache.events.encode("stats", await _dashboard_stats())
+            
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), DASHBOARD_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+                    continue
+                
+                if message is None:
+                    return
+                yield message
+        finally:
+            cache.events.unsubscribe(queue)
     
-    return body
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.get('/worker/{type}/{display_name}/data')
@@ -278,6 +454,7 @@ async def worker_data(type: str, display_name: str):
     
     try:
         c = await Client.get(display_name=display_name, type=type).prefetch_related("shard")
+        await _overlay_heartbeats([c])
         return {
             "display_name": c.display_name,
             "shard_number": c.shard.number if c.shard else "N/A",
@@ -414,25 +591,15 @@ async def custom_markasdone(inp: MarkAsDoneCPUInput):
             job.gpu = False
             job.closed = True
         await job.save()
+        await cache.counters.move("open", _job_state(job))
     
     if existed > 0:
-        if inp.token:
-            try:
-                client = await Client.get(token=token)
-                client.jobs_completed += existed
-                client.last_seen = int(time())
-                await client.save()
-            except Exception:
-                pass
+        async with in_transaction() as conn:
+            if inp.token:
+                await _complete_client(conn, inp.token, existed)
             
-        user, created = await CPU_Leaderboard.get_or_create(nickname=inp.nickname)
-        
-        if created:
-            user.jobs_completed = existed
-        else:
-            user.jobs_completed += existed
-        
-        await user.save()
+            await conn.execute_query(CUSTOM_QUERY_UPSERT_CPU_LEADERBOARD, [inp.nickname, existed])
+        await cache.leaderboards.incr("cpu", inp.nickname, existed)
  
         return {"status": "success", "completed": existed}
     else:
@@ -444,20 +611,17 @@ async def custom_markasdone(inp: MarkAsDoneInput):
     if inp.password != ADMIN_PASSWORD:
         return {"status": "failed", "detail": "Invalid password."}
     
-    existed = await Job.filter(number__in=inp.shards, closed=False, pending=False).count()
-    await Job.filter(number__in=inp.shards, closed=False, pending=False).update(closed=True, pending=False, completor=inp.nickname)
+    opened = await Job.filter(number__in=inp.shards, closed=False, pending=False, gpu=False).update(closed=True, pending=False, completor=inp.nickname)
+    gpu = await Job.filter(number__in=inp.shards, closed=False, pending=False, gpu=True).update(closed=True, pending=False, completor=inp.nickname)
+    existed = opened + gpu
+    
+    await cache.counters.move("open", "closed", opened)
+    await cache.counters.move("gpu", "closed", gpu)
     
     if existed > 0:
-        user, created = await Leaderboard.get_or_create(nickname=inp.nickname)
-        
-        if created:
-            user.jobs_completed = existed
-            user.pairs_scraped = inp.count
-        else:
-            user.jobs_completed += existed
-            user.pairs_scraped += inp.count
-        
-        await user.save()
+        async with in_transaction() as conn:
+            await conn.execute_query(CUSTOM_QUERY_UPSERT_LEADERBOARD, [inp.nickname, existed, inp.count])
+        await cache.leaderboards.incr("gpu", inp.nickname, existed, inp.count)
  
         return {"status": "success"}
     else:
@@ -466,21 +630,56 @@ async def custom_markasdone(inp: MarkAsDoneInput):
 
 @app.post('/api/isCompleted')
 async def isCompleted(inp: IsCompleteInput):
-    jobs = await Job.filter(gpu_url__in=inp.addresses, closed=True)
-    closeds = [job.gpu_url for job in jobs]
+    # An address counts as completed if its job is closed, or if there is no job with that address at all.
+    jobs = await Job.filter(gpu_url__in=inp.addresses).values_list("gpu_url", "closed")
     
-    for addr in inp.addresses:
-        if addr in closeds:
-            continue
-        elif not await Job.exists(gpu_url=addr):
-            closeds.append(addr)
-            
-    return closeds
+    opened = set()
+    closed = set()
+    for addr, is_closed in jobs:
+        (closed if is_closed else opened).add(addr)
+    
+    return [addr for addr in dict.fromkeys(inp.addresses) if addr in closed or addr not in opened]
 
 
 # API START ------
 
 
+def _job_state(job):
+    """ Returns the live counter state of job `job`. (see `cache.counters.JOB_STATES`) """
+    if job.closed:
+        return "closed"
+    elif job.pending:
+        return "pending"
+    elif job.gpu:
+        return "gpu"
+    else:
+        return "open"
+
+
+async def _get_client(token, type):
+    """ Returns the type, display name and nickname of the worker with token `token`, using the token cache where possible, or raises a 404 if it does not exist. """
+    client = await cache.tokens.get(token)
+    if client is None:
+        data = await Client.get_or_none(uuid=token)
+        if data is None:
+            raise HTTPException(status_code=404, detail="The server could not find this worker. Did the worker time out?")
+        
+        client = {"type": data.type, "display_name": data.display_name, "nickname": data.user_nickname}
+        await cache.tokens.set(token, data.type, data.display_name, data.user_nickname, data.shard_id)
+    
+    if client["type"] != type:
+        raise HTTPException(status_code=404, detail="The server could not find this worker. Did the worker time out?")
+    
+    return client
+
+
+async def _release_shard(uuid):
+    """ Returns the shard assigned to the worker with token `uuid` to the pool, if it has not been completed. """
+    released = await Tortoise.get_connection("default").execute_query_dict(CUSTOM_QUERY_RELEASE_SHARD, [uuid])
+    for job in released:
+        await cache.counters.move("pending", "gpu" if job["gpu"] else "open")
+
+
 @app.get('/api/new')
 async def new(nickname: str, type: Optional[str] = "HYBRID"):
     if type not in types:
@@ -503,11 +702,28 @@ async def new(nickname: str, type: Optional[str] = "HYBRID"):
         last_seen=ctime,
         shard=None
     )
+    await cache.counters.incr(f"clients:{type}")
+    await cache.tokens.set(uuid, type, display_name, nickname)
+    try:
+        # The live dashboard is only updated on a best-effort basis, as the worker has already been created.
+        await cache.events.publish("join", {
+            "type": type,
+            "display_name": display_name,
+            "shard_number": None,
+            "progress": "Initialized",
+            "jobs_completed": 0,
+            "user_nickname": nickname,
+            "last_seen": ctime
+        })
+    except Exception:
+        pass
     
-    if type == "CPU":
-        upload_addr = choice(UPLOAD_CPU_ADDRS)
-    else:
-        upload_addr = choice(UPLOAD_ADDRS)
+    addresses = UPLOAD_CPU_ADDRS if type == "CPU" else UPLOAD_ADDRS
+    try:
+        upload_addr = await cache.uploads.assign(addresses, uuid)
+    except Exception:
+        # The worker has already been created, so it is given a random upload address rather than failing. (which is not counted in the loads)
+        upload_addr = choice(addresses)
 
     return {"display_name": display_name, "token": uuid, "upload_address": upload_addr}
 
@@ -517,17 +733,41 @@ async def validateWorker(inp: TokenInput):
     if inp.type not in types:
         raise HTTPException(status_code=400, detail=f"Invalid worker type. Choose from: {types}.")
         
-    exists = await Client.exists(uuid=inp.token, type=inp.type)
+    try:
+        await _get_client(inp.token, inp.type)
+    except HTTPException:
+        return str(False)
     
-    return str(exists)
+    return str(True)
 
 
 @app.get('/api/getUploadAddress', response_class=PlainTextResponse)
-async def getUploadAddress(type: Optional[str] = "HYBRID"):
-    if type == "CPU":
-        return choice(UPLOAD_CPU_ADDRS)
-    else:
-        return choice(UPLOAD_ADDRS)
+async def getUploadAddress(type: Optional[str] = "HYBRID", token: Optional[str] = None):
+    if type not in types:
+        raise HTTPException(status_code=400, detail=f"Invalid worker type. Choose from: {types}.")
+    
+    # Workers which send their token are moved to the returned address, otherwise the address is handed out without being tracked.
+    if token is not None:
+        await _get_client(token, type)
+    
+    return await cache.uploads.assign(UPLOAD_CPU_ADDRS if type == "CPU" else UPLOAD_ADDRS, token)
+
+
+@app.post('/api/uploadFailed', response_class=PlainTextResponse)
+async def uploadFailed(inp: UploadFailedInput):
+    if inp.type not in types:
+        raise HTTPException(status_code=400, detail=f"Invalid worker type. Choose from: {types}.")
+    
+    await _get_client(inp.token, inp.type)
+    
+    addresses = UPLOAD_CPU_ADDRS if inp.type == "CPU" else UPLOAD_ADDRS
+    address = inp.address or await cache.uploads.assigned(inp.token)
+    if address not in addresses:
+        raise HTTPException(status_code=400, detail="Invalid upload address.")
+    
+    # The failure is recorded, and the worker is moved to another address to retry the upload.
+    await cache.uploads.report_failure(address)
+    return await cache.uploads.assign(addresses, inp.token, avoid=address)
 
 
 @app.post('/api/newJob')
@@ -537,76 +777,179 @@ async def newJob(inp: TokenInput):
     if inp.type == "HYBRID":
         raise HTTPException(status_code=403, detail="Hybrid workers are no longer supported - consider creating a CPU worker instead.")
     
-    try:
-        client = await Client.get(uuid=inp.token, type=inp.type).prefetch_related("shard")
-    except:
-        raise HTTPException(status_code=404, detail="The server could not find this worker. Did the worker time out?")
+    await _get_client(inp.token, inp.type)
+    await _release_shard(inp.token)
     
-    if client.shard is not None and client.shard.pending:
-        client.shard.pending = False
-        await client.shard.save()
+    # Jobs reserved in advance by `refill_job_queues` are already pending, so we only need to assign it to the client.
+    while True:
+        job = await cache.queue.pop(inp.type)
+        if job is None:
+            break
+        
+        try:
+            async with in_transaction() as conn:
+                result = (await conn.execute_query_dict(CUSTOM_QUERY_ASSIGN_QUEUED, [
+                    inp.token, job["number"], QUEUE_COMPLETOR, int(time()) + JOB_LEASE_TIMEOUT, int(time())
+                ]))[0]
+                if not result["assigned"] and (result["claimed"] or not result["worker"]):
+                    raise HTTPException(status_code=404, detail="The server could not find this worker. Did the worker time out?")
+        except HTTPException:
+            # The worker has been deleted (e.g. the token cache had not yet been invalidated), so any claim is rolled back,
+            # and the job is returned to the queue for another worker.
+            await cache.queue.push(inp.type, [job])
+            raise
+        
+        if not result["assigned"]:
+            continue # The job's reservation was released whilst it was queued, so we try the next one.
+        
+        metrics.incr("crawlingathome_job_claims_total", {"type": inp.type, "source": "queue"})
+        await cache.tokens.set_shard([inp.token], job["number"])
+        
+        url = job["gpu_url"] if inp.type == "GPU" else job["url"]
+        return {"url": url, "start_id": job["start_id"], "end_id": job["end_id"], "shard": job["shard_of_chunk"], "number": job["number"]}
 
     if inp.type == "GPU":         
         try:
             # Empty out any existing jobs that may cause errors.
-            await Job.filter(completor=client.uuid, pending=True).update(completor=None, pending=False)
+            released = await Job.filter(completor=inp.token, pending=True).update(completor=None, pending=False)
+            await cache.counters.move("pending", "gpu", released)
             
             # We update with completor to be able to find the job and make it pending in a single request, and we later set it back to None.
             # This helps us avoid workers getting assigned the same job.
             # We also had to use a raw SQL query here, as tortoise-orm was not complex enough to allow us to perform this type of command.
             async with in_transaction() as conn:
                 await conn.execute_query(
-                    CUSTOM_QUERY_GPU.format(client.uuid)
+                    CUSTOM_QUERY_GPU.format(inp.token)
                 )
-            job = await Job.get(completor=client.uuid, pending=True)
+            job = await Job.get(completor=inp.token, pending=True)
         except:
+            metrics.incr("crawlingathome_job_claims_total", {"type": inp.type, "source": "none"})
             raise HTTPException(status_code=403, detail="Either there are no new GPU jobs available, or there was an error whilst finding a job. Keep retrying, as GPU jobs are dynamically created.")
         
+        metrics.incr("crawlingathome_job_claims_total", {"type": inp.type, "source": "database"})
         job.completor = None
+        job.lease_expires = int(time()) + JOB_LEASE_TIMEOUT
         await job.save()
+        await cache.counters.move("gpu" if inp.type == "GPU" else "open", "pending")
         
-        client.shard = job
-        client.progress = "Recieved new job"
-        client.last_seen = int(time())
-        await client.save()
+        await Client.filter(uuid=inp.token).update(shard_id=job.number, progress="Recieved new job", last_seen=int(time()))
+        await cache.tokens.set_shard([inp.token], job.number)
         
         return {"url": job.gpu_url, "start_id": job.start_id, "end_id": job.end_id, "shard": job.shard_of_chunk, "number": job.number}
     else:
         try:
             # Empty out any existing jobs that may cause errors.
-            await Job.filter(completor=client.uuid, pending=True).update(completor=None, pending=False)
+            released = await Job.filter(completor=inp.token, pending=True).update(completor=None, pending=False)
+            await cache.counters.move("pending", "open", released)
             
             # We update with completor to be able to find the job and make it pending in a single request, and we later set it back to None.
             # This helps us avoid workers getting assigned the same job.
             # We also had to use a raw SQL query here, as tortoise-orm was not complex enough to allow us to perform this type of command.
             async with in_transaction() as conn:
                 await conn.execute_query(
-                    CUSTOM_QUERY_CPU_HYBRID.format(client.uuid)
+                    CUSTOM_QUERY_CPU_HYBRID.format(inp.token)
                 )
-            job = await Job.get(completor=client.uuid, pending=True)
+            job = await Job.get(completor=inp.token, pending=True)
         except:
+            metrics.incr("crawlingathome_job_claims_total", {"type": inp.type, "source": "none"})
             raise HTTPException(status_code=403, detail="Either there are no more jobs available, or an error occurred whilst finding a job.")
         
+        metrics.incr("crawlingathome_job_claims_total", {"type": inp.type, "source": "database"})
         job.completor = None
+        job.lease_expires = int(time()) + JOB_LEASE_TIMEOUT
         await job.save()
+        await cache.counters.move("gpu" if inp.type == "GPU" else "open", "pending")
         
-        client.shard = job
-        client.progress = "Recieved new job"
-        client.last_seen = int(time())
-        await client.save()      
+        await Client.filter(uuid=inp.token).update(shard_id=job.number, progress="Recieved new job", last_seen=int(time()))
+        await cache.tokens.set_shard([inp.token], job.number)
         
         return {"url": job.url, "start_id": job.start_id, "end_id": job.end_id, "shard": job.shard_of_chunk, "number": job.number}
 
 
+@app.post('/api/newJobs')
+async def newJobs(inp: TokenInput):
+    if inp.type not in types:
+        raise HTTPException(status_code=400, detail=f"Invalid worker type. Choose from: {types}.")
+    if inp.type == "HYBRID":
+        raise HTTPException(status_code=403, detail="Hybrid workers are no longer supported - consider creating a CPU worker instead.")
+    if inp.count is None or inp.count < 1 or inp.count > MAX_BULK_JOBS:
+        raise HTTPException(status_code=400, detail=f"The job count must be between 1 and {MAX_BULK_JOBS}.")
+    
+    await _get_client(inp.token, inp.type)
+    await _release_shard(inp.token)
+    
+    # Jobs claimed in bulk keep the client's UUID as their completor until they are marked as done.
+    jobs = await _reserve_jobs(inp.type, inp.count, completor=inp.token, lease_expires=int(time()) + JOB_LEASE_TIMEOUT)
+    metrics.incr("crawlingathome_job_claims_total", {"type": inp.type, "source": "database"}, len(jobs))
+    metrics.incr("crawlingathome_job_claims_total", {"type": inp.type, "source": "none"}, inp.count - len(jobs))
+    if not jobs:
+        if inp.type == "GPU":
+            raise HTTPException(status_code=403, detail="Either there are no new GPU jobs available, or there was an error whilst finding a job. Keep retrying, as GPU jobs are dynamically created.")
+        else:
+            raise HTTPException(status_code=403, detail="Either there are no more jobs available, or an error occurred whilst finding a job.")
+    
+    await Client.filter(uuid=inp.token).update(shard_id=None, progress=f"Recieved {len(jobs)} new jobs", last_seen=int(time()))
+    await cache.tokens.set_shard([inp.token], None)
+    
+    return [
+        {
+            "url": job["gpu_url"] if inp.type == "GPU" else job["url"],
+            "start_id": job["start_id"],
+            "end_id": job["end_id"],
+            "shard": job["shard_of_chunk"],
+            "number": job["number"]
+        }
+        for job in jobs
+    ]
+
+
+@app.post('/api/newChunk')
+async def newChunk(inp: TokenInput):
+    if inp.type not in types:
+        raise HTTPException(status_code=400, detail=f"Invalid worker type. Choose from: {types}.")
+    if inp.type != "CPU":
+        raise HTTPException(status_code=403, detail="Only CPU workers can claim whole chunks - GPU jobs each have their own download.")
+    
+    await _get_client(inp.token, inp.type)
+    await _release_shard(inp.token)
+    
+    # Every open shard of one chunk is claimed at once, so the worker only downloads the chunk's WAT file once.
+    # The jobs are tracked like jobs claimed in bulk, and are marked as done using /api/markJobsAsDone.
+    async with in_transaction() as conn:
+        jobs = await conn.execute_query_dict(CUSTOM_QUERY_CPU_CHUNK, [inp.token, int(time()) + JOB_LEASE_TIMEOUT])
+    
+    if not jobs:
+        metrics.incr("crawlingathome_job_claims_total", {"type": inp.type, "source": "none"})
+        raise HTTPException(status_code=403, detail="Either there are no more jobs available, or an error occurred whilst finding a job.")
+    
+    metrics.incr("crawlingathome_job_claims_total", {"type": inp.type, "source": "chunk"}, len(jobs))
+    await cache.counters.move("open", "pending", len(jobs))
+    
+    await Client.filter(uuid=inp.token).update(shard_id=None, progress=f"Recieved {len(jobs)} new jobs", last_seen=int(time()))
+    await cache.tokens.set_shard([inp.token], None)
+    
+    return [
+        {
+            "url": job["url"],
+            "start_id": job["start_id"],
+            "end_id": job["end_id"],
+            "shard": job["shard_of_chunk"],
+            "number": job["number"]
+        }
+        for job in sorted(jobs, key=lambda job: job["shard_of_chunk"])
+    ]
+
+
 @app.get('/api/jobCount', response_class=PlainTextResponse)
 async def jobCount(type: Optional[str] = "HYBRID"):
     if type not in types:
         raise HTTPException(status_code=400, detail=f"Invalid worker type. Choose from: {types}.")
         
-    if type == "GPU":
-        count = await Job.filter(pending=False, closed=False, gpu=True).count()
-    else:
-        count = await Job.filter(pending=False, closed=False, gpu=False).count()
+    counts = await cache.counters.get_all()
+    count = counts["gpu"] if type == "GPU" else counts["open"]
+    
+    # Jobs reserved in the job queues are still available to workers.
+    count += await cache.queue.length("GPU" if type == "GPU" else "CPU")
     
     return str(count)
 
@@ -616,85 +959,118 @@ async def updateProgress(inp: TokenProgressInput):
     if inp.type not in types:
         raise HTTPException(status_code=400, detail=f"Invalid worker type. Choose from: {types}.")
     
-    try:
-        await Client.get(uuid=inp.token, type=inp.type).update(progress=inp.progress, last_seen=int(time()))
-    except:
-        raise HTTPException(status_code=404, detail="The server could not find this worker. Did the worker time out?")
+    await _get_client(inp.token, inp.type)
+    
+    # Progress updates are buffered in Redis and written to the database in batches by `flush_heartbeats`, which also extends the lease on the worker's jobs.
+    await cache.heartbeats.record(inp.token, inp.progress, int(time()))
     
     return "success"
 
 
+async def _complete_client(conn, uuid, count):
+    """ Atomically adds `count` completed jobs to the client with UUID `uuid`, within the transaction `conn`. """
+    await Client.filter(uuid=uuid).using_db(conn).update(
+        progress="Completed Job",
+        jobs_completed=F("jobs_completed") + count,
+        last_seen=int(time())
+    )
+
+
 @app.post('/api/markAsDone', response_class=PlainTextResponse)
 async def markAsDone(inp: TokenCountInput):
     if inp.type not in types:
         raise HTTPException(status_code=400, detail=f"Invalid worker type. Choose from: {types}.")
     
-    try:
-        client = await Client.get(uuid=inp.token, type=inp.type).prefetch_related("shard")
-    except:
-        raise HTTPException(status_code=404, detail="The server could not find this worker. Did the worker time out?")
-    
-    if client.shard is None:
-        raise HTTPException(status_code=403, detail="You do not have an open job.")
-    if client.shard.closed:
-        raise HTTPException(status_code=403, detail="This job has already been marked as completed!")
+    client = await _get_client(inp.token, inp.type)
     
     if inp.type == "CPU":
         if inp.url is None:
             raise HTTPException(status_code=400, detail="The worker did not submit valid download data.")
         
-        client.shard.gpu = True
-        client.shard.pending = False
-        client.shard.gpu_url = inp.url
-        client.shard.cpu_completor = client.user_nickname
-        if "postgres" in client.shard.gpu_url:
-            client.shard.gpu = False
-            client.shard.closed = True
-        await client.shard.save()
-        
-        client.shard = None
-        client.progress = "Completed Job"
-        client.jobs_completed += 1
-        client.last_seen = int(time())
-        await client.save()
-
-        user, created = await CPU_Leaderboard.get_or_create(nickname=client.user_nickname)
-        if created:
-            user.jobs_completed = 1
-        else:
-            user.jobs_completed += 1
-            
-        await user.save()
-        
         # completion + completion_str are not affected by CPU jobs.
-        
-        return "success"
+        query, values = CUSTOM_QUERY_MARK_DONE_CPU, [inp.token, client["nickname"], inp.url, int(time())]
     else:
         if not inp.count:
             raise HTTPException(status_code=400, detail="The worker did not submit a valid count!")
         
-        client.shard.closed = True
-        client.shard.pending = False
-        client.shard.completor = client.user_nickname
-        await client.shard.save()
-        
-        client.shard = None
-        client.progress = "Completed Job"
-        client.jobs_completed += 1
-        client.last_seen = int(time())
-        await client.save()
+        query, values = CUSTOM_QUERY_MARK_DONE_GPU_HYBRID, [inp.token, client["nickname"], inp.count, int(time())]
+    
+    async with in_transaction() as conn:
+        done = await conn.execute_query_dict(query, values)
+    
+    if not done:
+        if await cache.tokens.get_shard(inp.token) is None:
+            raise HTTPException(status_code=403, detail="You do not have an open job.")
+        raise HTTPException(status_code=403, detail="This job has already been marked as completed!")
+    
+    await cache.tokens.set_shard([inp.token], None)
+    
+    if inp.type == "CPU" and not done[0]["closed"]:
+        await cache.counters.move("pending", "gpu")
+    else:
+        await cache.counters.move("pending", "closed")
+    
+    if inp.type == "CPU":
+        await cache.leaderboards.incr("cpu", client["nickname"], 1)
+    else:
+        await cache.leaderboards.incr("gpu", client["nickname"], 1, inp.count)
+    
+    return "success"
 
-        user, created = await Leaderboard.get_or_create(nickname=client.user_nickname)
-        if created:
-            user.jobs_completed = 1
-            user.pairs_scraped = inp.count
-        else:
-            user.jobs_completed += 1
-            user.pairs_scraped += inp.count
-        
-        await user.save()
 
-        return "success"
+@app.post('/api/markJobsAsDone', response_class=PlainTextResponse)
+async def markJobsAsDone(inp: TokenJobsInput):
+    if inp.type not in types:
+        raise HTTPException(status_code=400, detail=f"Invalid worker type. Choose from: {types}.")
+    
+    client = await _get_client(inp.token, inp.type)
+    
+    if not inp.jobs:
+        raise HTTPException(status_code=400, detail="The worker did not submit any jobs.")
+    
+    numbers = [job.number for job in inp.jobs]
+    
+    if inp.type == "CPU":
+        if any(job.url is None for job in inp.jobs):
+            raise HTTPException(status_code=400, detail="The worker did not submit valid download data.")
+        
+        async with in_transaction() as conn:
+            done = await conn.execute_query_dict(
+                CUSTOM_QUERY_COMPLETE_CPU,
+                [inp.token, client["nickname"], numbers, [job.url for job in inp.jobs]]
+            )
+            if done:
+                await _complete_client(conn, inp.token, len(done))
+                await conn.execute_query(CUSTOM_QUERY_UPSERT_CPU_LEADERBOARD, [client["nickname"], len(done)])
+    else:
+        if any(not job.count for job in inp.jobs):
+            raise HTTPException(status_code=400, detail="The worker did not submit a valid count!")
+        
+        counts = {job.number: job.count for job in inp.jobs}
+        
+        async with in_transaction() as conn:
+            done = await conn.execute_query_dict(
+                CUSTOM_QUERY_COMPLETE_GPU_HYBRID,
+                [inp.token, client["nickname"], numbers]
+            )
+            if done:
+                pairs = sum(counts[row["number"]] for row in done)
+                await _complete_client(conn, inp.token, len(done))
+                await conn.execute_query(CUSTOM_QUERY_UPSERT_LEADERBOARD, [client["nickname"], len(done), pairs])
+    
+    if not done:
+        raise HTTPException(status_code=403, detail="None of these jobs are open jobs assigned to this worker.")
+    
+    closed = sum(1 for row in done if row["closed"]) if inp.type == "CPU" else len(done)
+    await cache.counters.move("pending", "closed", closed)
+    await cache.counters.move("pending", "gpu", len(done) - closed)
+    
+    if inp.type == "CPU":
+        await cache.leaderboards.incr("cpu", client["nickname"], len(done))
+    else:
+        await cache.leaderboards.incr("gpu", client["nickname"], len(done), pairs)
+    
+    return "success"
 
 
 @app.post('/api/gpuInvalidDownload', response_class=PlainTextResponse)
@@ -702,23 +1078,25 @@ async def gpuInvalidDownload(inp: TokenInput):
     if inp.type not in types:
         raise HTTPException(status_code=400, detail=f"Invalid worker type. Choose from: {types}.")
     
-    try:
-        client = await Client.get(uuid=inp.token, type=inp.type).prefetch_related("shard")
-    except:
-        raise HTTPException(status_code=404, detail="The server could not find this worker. Did the worker time out?")
+    await _get_client(inp.token, inp.type)
+    client = await Client.get(uuid=inp.token).prefetch_related("shard")
     
     if client.shard is None:
         raise HTTPException(status_code=403, detail="This worker is not currently working on a job.")
     
+    state = _job_state(client.shard)
+    
     client.shard.gpu_url = None
     client.shard.gpu = False
     client.shard.pending = False
     client.shard.cpu_completor = None
     await client.shard.save()
+    await cache.counters.move(state, _job_state(client.shard))
     
     client.shard = None
     client.last_seen = int(time())
     await client.save()
+    await cache.tokens.set_shard([inp.token], None)
     
     return "success"
 
@@ -728,16 +1106,27 @@ async def bye(inp: TokenInput):
     if inp.type not in types:
         raise HTTPException(status_code=400, detail=f"Invalid worker type. Choose from: {types}.")
     
-    try:
-        client = await Client.get(uuid=inp.token, type=inp.type).prefetch_related("shard")
-    except:
-        raise HTTPException(status_code=404, detail="The server could not find this worker. Did the worker time out?")
+    await _get_client(inp.token, inp.type)
+    client = await Client.get(uuid=inp.token).prefetch_related("shard")
         
     if client.shard != None:
+        state = _job_state(client.shard)
         client.shard.pending = False
         await client.shard.save()
+        await cache.counters.move(state, _job_state(client.shard))
+    
+    # Release any jobs claimed in bulk.
+    released = await Job.filter(completor=client.uuid, pending=True).update(pending=False, completor=None)
+    await cache.counters.move("pending", "gpu" if client.type == "GPU" else "open", released)
     
     await client.delete()
+    await cache.counters.incr(f"clients:{client.type}", -1)
+    await cache.tokens.invalidate([client.uuid])
+    await cache.uploads.release([client.uuid])
+    try:
+        await cache.events.publish("leave", [{"type": client.type, "display_name": client.display_name}])
+    except Exception:
+        pass
     
     return "success"
 
@@ -747,16 +1136,199 @@ async def bye(inp: TokenInput):
 
 async def check_idle():
     while True:
-        await asyncio.sleep(300)
-        t = int(time()) - IDLE_TIMEOUT
+        await asyncio.sleep(IDLE_CHECK_INTERVAL)
+        
+        try:
+            start = perf_counter()
+            async with in_transaction() as conn:
+                rows = await conn.execute_query_dict(CUSTOM_QUERY_REAP_IDLE, [int(time()) - IDLE_TIMEOUT])
+        except Exception:
+            continue
+        
+        counts = {row["counter"]: row["count"] for row in rows}
+        clients = sum(count for counter, count in counts.items() if counter.startswith("clients:"))
+        jobs = counts.get("open", 0) + counts.get("gpu", 0)
+        if clients or jobs:
+            print(f"[check_idle] reaped {clients} idle workers and released {jobs} jobs in {(perf_counter() - start) * 1000:.1f}ms")
+        
+        try:
+            reaped = [uuid for row in rows for uuid in row["uuids"] or []]
+            await cache.tokens.invalidate(reaped)
+            await cache.uploads.release(reaped)
+            
+            for counter, count in counts.items():
+                if counter.startswith("clients:"):
+                    await cache.counters.incr(counter, -count)
+                else:
+                    await cache.counters.move("pending", counter, count)
+            
+            left = [{"type": row["counter"][8:], "display_name": name} for row in rows for name in row["names"] or []]
+            if left:
+                await cache.events.publish("leave", left)
+        except Exception:
+            pass # The clients have already been reaped, and the counters are corrected by `reconcile_counters`.
+
+        
+async def flush_heartbeats():
+    while True:
+        await asyncio.sleep(HEARTBEAT_FLUSH_INTERVAL)
+        
+        try:
+            heartbeats = await cache.heartbeats.take()
+            if not heartbeats:
+                continue
+            
+            uuids = list(heartbeats)
+            workers = await Tortoise.get_connection("default").execute_query_dict(CUSTOM_QUERY_FLUSH_HEARTBEATS, [
+                uuids,
+                [heartbeats[uuid]["progress"] for uuid in uuids],
+                [heartbeats[uuid]["last_seen"] for uuid in uuids],
+                JOB_LEASE_TIMEOUT
+            ])
+            await cache.heartbeats.flushed()
+        except Exception:
+            continue # The updates are kept in Redis, and retried on the next flush.
+        
+        try:
+            # Each flush is sent to the live dashboard as a single batch of progress updates.
+            if workers:
+                await cache.events.publish("progress", workers)
+        except Exception:
+            pass
+
+        
+async def publish_dashboard_stats():
+    last = {}
+    while True:
+        await asyncio.sleep(DASHBOARD_EVENT_INTERVAL)
         
-        clients = await Client.filter(last_seen__lte=t, shard_id__not_isnull=True).prefetch_related("shard")
-        for client in clients:
-            if client.shard.pending:
-                client.shard.pending = False
-                await client.shard.save()
+        try:
+            # Only the stats which changed since the last check are sent to the live dashboard.
+            stats = await _dashboard_stats()
+            changed = {key: value for key, value in stats.items() if last.get(key) != value}
+            if changed:
+                await cache.events.publish("stats", changed)
+            last = stats
+        except Exception:
+            pass
+
         
-        await Client.filter(last_seen__lte=t).delete()
+async def release_expired_jobs():
+    while True:
+        await asyncio.sleep(JOB_LEASE_SWEEP_INTERVAL)
+        
+        try:
+            rows = await Tortoise.get_connection("default").execute_query_dict(CUSTOM_QUERY_RELEASE_EXPIRED, [int(time())])
+        except Exception:
+            continue
+        
+        for row in rows:
+            await cache.counters.move("pending", row["state"], row["count"])
+        
+        if rows:
+            await cache.tokens.set_shard(rows[0]["uuids"] or [], None)
+
+        
+async def _reserve_jobs(type, count, completor=QUEUE_COMPLETOR, lease_expires=None):
+    """ Marks up to `count` random open jobs for worker type `type` as pending with completor `completor` and lease `lease_expires`, returning their data. """
+    query = CUSTOM_QUERY_RESERVE_GPU if type == "GPU" else CUSTOM_QUERY_RESERVE_CPU_HYBRID
+    
+    async with in_transaction() as conn:
+        data = await conn.execute_query_dict("SELECT MAX(\"number\") AS \"number\" FROM \"job\";")
+        start = randint(0, data[0]["number"] or 0)
+        
+        # Scan upwards from a random shard number, wrapping around to the start of the table if needed.
+        jobs = await conn.execute_query_dict(query, [completor, lease_expires, start, count])
+        if len(jobs) < count:
+            jobs += await conn.execute_query_dict(query, [completor, lease_expires, 0, count - len(jobs)])
+    
+    await cache.counters.move("gpu" if type == "GPU" else "open", "pending", len(jobs))
+    
+    shuffle(jobs)
+    return jobs
+
+
+async def refill_job_queues():
+    # Return any reservations left behind by a previous server (e.g. after a crash), which are neither queued nor assigned to a worker.
+    while True:
+        try:
+            queued = await cache.queue.numbers("CPU") + await cache.queue.numbers("GPU")
+            released = await Tortoise.get_connection("default").execute_query_dict(CUSTOM_QUERY_RELEASE_ORPHANED, [QUEUE_COMPLETOR, queued])
+            gpu = sum(job["gpu"] for job in released)
+            await cache.counters.move("pending", "gpu", gpu)
+            await cache.counters.move("pending", "open", len(released) - gpu)
+            break
+        except Exception:
+            await asyncio.sleep(5)
+    
+    while True:
+        for type in ["CPU", "GPU"]:
+            try:
+                # Return reservations which have sat unused for too long back to the pool.
+                expired = await cache.queue.pop_expired(type, JOB_QUEUE_TIMEOUT)
+                if expired:
+                    released = await Job.filter(number__in=expired, pending=True, completor=QUEUE_COMPLETOR).update(pending=False, completor=None)
+                    await cache.counters.move("pending", "gpu" if type == "GPU" else "open", released)
+                
+                missing = JOB_QUEUE_SIZE - await cache.queue.length(type)
+                if missing > 0:
+                    await cache.queue.push(type, await _reserve_jobs(type, missing))
+            except Exception:
+                pass
+        
+        await asyncio.sleep(JOB_QUEUE_REFILL_INTERVAL)
+
+        
+async def reconcile_counters():
+    while True:
+        try:
+            # Recount everything from the database, correcting any drift in the live counters.
+            counts = {key: 0 for key in cache.counters.JOB_STATES}
+            for row in await Tortoise.get_connection("default").execute_query_dict(CUSTOM_QUERY_COUNT_JOBS):
+                counts[row["state"]] = row["count"]
+            
+            for type in types:
+                counts[f"clients:{type}"] = await Client.filter(type=type).count()
+            
+            await cache.counters.set_all(counts)
+            
+            # The leaderboards are also rebuilt if they no longer match the database, correcting any increments lost (e.g. whilst Redis was unavailable).
+            # (a board which still matches is left alone, as a job completed just as a rebuild starts may be counted twice)
+            for board in ["gpu", "cpu"]:
+                users = await _leaderboard_users(board)
+                if not await cache.leaderboards.ready(board) or await cache.leaderboards.length(board) != len(users) \
+                   or await cache.leaderboards.total(board) != sum(jobs for _, jobs, _ in users):
+                    await _rebuild_leaderboard(board)
+            
+            # Upload assignments left behind by deleted workers are released, and the load on each upload address is recounted.
+            # (workers assigned after the assignments are read are left alone, as they are always created before being assigned)
+            assigned = await cache.uploads.assignments()
+            rows = await Tortoise.get_connection("default").execute_query_dict('SELECT "uuid" FROM "client" WHERE "uuid" = ANY($1::text[]);', [list(assigned)])
+            live = {row["uuid"] for row in rows}
+            await cache.uploads.release([uuid for uuid in assigned if uuid not in live])
+            await cache.uploads.recount()
+        except Exception:
+            await asyncio.sleep(5)
+            continue
+        
+        await asyncio.sleep(COUNTER_RECONCILE_INTERVAL)
+
+
+async def prewarm_pages():
+    while True:
+        # Re-render the most visited pages shortly before they expire, so they are never rendered on request.
+        for page, render in PREWARMED_PAGES.items():
+            try:
+                lock = await cache.page.acquire_lock(page)
+                if lock is not None:
+                    try:
+                        await cache.page.set(page, await render())
+                    finally:
+                        await cache.page.release_lock(page, lock)
+            except Exception:
+                pass
+        
+        await asyncio.sleep(max(PAGE_CACHE_EXPIRY - 5, 1))
 
         
 async def calculate_eta():
@@ -782,12 +1354,15 @@ async def calculate_eta():
     dataset = []
     while True:
         try:
-            start = await Job.filter(closed=True).count()
-        except:
+            # Wait for the counters to be set by `reconcile_counters`.
+            if not await cache.client.exists("counters"):
+                raise ValueError
+            start = (await cache.counters.get_all())["closed"]
+        except Exception:
             await asyncio.sleep(5)
             continue
         await asyncio.sleep(AVERAGE_INTERVAL)
-        end = await Job.filter(closed=True).count()
+        end = (await cache.counters.get_all())["closed"]
 
         dataset.append(end - start)
         if len(dataset) > AVERAGE_DATASET_LENGTH:
@@ -795,7 +1370,7 @@ async def calculate_eta():
 
         mean = sum(dataset) / len(dataset)
         mean_per_second = mean / AVERAGE_INTERVAL
-        remaining = await Job.filter(closed=False, pending=False, gpu=False).count()
+        remaining = (await cache.counters.get_all())["open"]
 
         try:
             length = remaining // mean_per_second
@@ -809,34 +1384,79 @@ async def calculate_eta():
 
 
 async def update_pairs_count():
-    while True:
-        await cache.client.set("pairs", 2323000000)
-        await cache.client.set("ml-pairs", 2381000000)
-        
-        jsn = get("http://116.202.162.146:8000/info/?key=nolang").json()
-        pairs = jsn.get("Number of items inserted", "N/A")
-        await cache.client.set("nl-pairs", pairs)
-        
-        await asyncio.sleep(25)
+    delay = PAIRS_POLL_INTERVAL
+    async with httpx.AsyncClient(timeout=PAIRS_POLL_TIMEOUT) as http:
+        while True:
+            try:
+                # The pairs counts of the finished datasets are fixed, and are set on every poll in case Redis was unavailable or has been flushed.
+                await cache.client.mset({"pairs": 2323000000, "ml-pairs": 2381000000})
+                
+                r = await http.get(NOLANG_PAIRS_URL)
+                r.raise_for_status()
+                await cache.client.set("nl-pairs", int(r.json()["Number of items inserted"]))
+                delay = PAIRS_POLL_INTERVAL
+            except Exception:
+                # Keep the last known good value, and back off while the source is unavailable.
+                delay = min(delay * 2, PAIRS_POLL_MAX_BACKOFF)
+            
+            await asyncio.sleep(delay)
 
 
 # FASTAPI UTILITIES START ------ 
     
     
+leader_tasks = []
+
+
+def start_leader_tasks():
+    # The following functions only need to be executed on a single worker.
+    timers = [check_idle, flush_heartbeats, release_expired_jobs, refill_job_queues, reconcile_counters, calculate_eta, update_pairs_count, publish_dashboard_stats]
+    if PAGE_CACHE_PREWARM:
+        timers.append(prewarm_pages)
+    
+    leader_tasks.extend(asyncio.create_task(timer()) for timer in timers)
+
+
+def stop_leader_tasks():
+    for task in leader_tasks:
+        task.cancel()
+    leader_tasks.clear()
+
+
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    start = perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Requests are labelled with the path of the route they matched, rather than the full URL, to keep the number of series bounded.
+        route = request.scope.get("route")
+        metrics.request(request.method, route.path if route is not None else "unmatched", status, perf_counter() - start)
+
+
 @app.on_event('startup')
 async def app_startup():
-    # Finds the worker number for this worker.
-    await cache.initPID()
+    # Every worker keeps its local page cache up to date.
+    asyncio.create_task(cache.page.listen())
+    asyncio.create_task(cache.tokens.listen())
+    asyncio.create_task(cache.events.listen())
+    app.state.metrics = asyncio.create_task(metrics.run(METRICS_FLUSH_INTERVAL))
     
-    if cache.iszeroworker:
-        # The following functions only need to be executed on a single worker.
-        asyncio.create_task(check_idle())
-        asyncio.create_task(calculate_eta())
-        asyncio.create_task(update_pairs_count())
+    # Every worker competes for the leader lease, and the current leader (zero worker) runs the background tasks.
+    app.state.leader = asyncio.create_task(cache.leader.run(start_leader_tasks, stop_leader_tasks))
 
 
 @app.on_event('shutdown')
 async def app_shutdown():
+    app.state.leader.cancel()
+    stop_leader_tasks()
+    
+    # The metrics counted since the last flush are flushed before Redis is closed.
+    app.state.metrics.cancel()
+    await asyncio.gather(app.state.metrics, return_exceptions=True)
     await cache.safeShutdown()
 
 
@@ -0,0 +1,152 @@
+import numpy as np
+import json
+import os
+import re
+import sys
+
+# JOB MANIFEST -----
+# A compact, columnar copy of `original.json`, which can be memory-mapped instead of parsed.
+# Row `i` of the manifest contains shard number `i + 1`, just like `original.json`.
+# Usage: python manifest.py [path to original.json] [output directory]
+#
+# Files in the manifest directory:
+# - manifest.json: the number of shards and URLs.
+# - start_id.bin, end_id.bin (int64), shard.bin (uint8): one value per shard.
+# - url_index.bin (uint32): the index of each shard's URL in the URL table.
+# - urls.bin (utf-8) + url_offsets.bin (int64): the URL table. (both shards of a chunk share a single URL)
+
+DEFAULT_SOURCE = "jobs/original.json"
+DEFAULT_PATH = "jobs/manifest"
+
+_SEPARATORS = re.compile(r"[\s,]*")
+_NUMBER = re.compile(r"[-+0-9.eE]*")
+
+def iter_json_array(path, chunk_size=1 << 20):
+    """ Yields each item of the JSON array stored at `path`, reading the file `chunk_size` characters at a time. """
+    decoder = json.JSONDecoder()
+
+    with open(path, "r") as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{path} does not contain a JSON array.")
+
+        pos, eof = 1, False
+        while True:
+            pos = _SEPARATORS.match(buffer, pos).end()
+            if buffer[pos:pos + 1] == "]":
+                return
+
+            try:
+                # A number at the very end of the buffer may have been cut off mid-way (e.g. `2.` or `-3e`), so it is only decoded once more has been read.
+                if not eof and _NUMBER.fullmatch(buffer, pos):
+                    raise ValueError
+
+                item, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if eof:
+                    raise
+
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+
+            yield item
+            pos = end
+
+def shard_numbers(end_ids, shards):
+    """ Returns the shard number of every job, given arrays of their `end_id`s and shards of the chunk. (2 shards per chunk of 1,000,000 samples) """
+    return (np.asarray(end_ids, dtype=np.int64) * 2) // 1000000 - (np.asarray(shards) == 0)
+
+
+class Manifest:
+    def __init__(self, path: str = DEFAULT_PATH):
+        """ Memory-maps the manifest stored in the directory `path`. """
+        with open(os.path.join(path, "manifest.json"), "r") as f:
+            info = json.load(f)
+
+        def _map(name, dtype, length):
+            if length == 0:
+                return np.zeros(0, dtype=dtype)
+            return np.memmap(os.path.join(path, name), dtype=dtype, mode="r", shape=(length,))
+
+        self.start_id = _map("start_id.bin", np.int64, info["count"])
+        self.end_id = _map("end_id.bin", np.int64, info["count"])
+        self.shard = _map("shard.bin", np.uint8, info["count"])
+        self.url_index = _map("url_index.bin", np.uint32, info["count"])
+        self.url_offsets = _map("url_offsets.bin", np.int64, info["urls"] + 1)
+        self.urls = _map("urls.bin", np.uint8, int(self.url_offsets[-1]))
+
+    def __len__(self):
+        return len(self.start_id)
+
+    def url(self, index) -> str:
+        """ Returns the URL with index `index` in the URL table. """
+        return self.urls[self.url_offsets[index]:self.url_offsets[index + 1]].tobytes().decode()
+
+    def numbers(self):
+        """ Returns the shard number of every row, computed from the manifest's `end_id`s and shards. """
+        return shard_numbers(self.end_id, self.shard)
+
+
+def convert(source: str = DEFAULT_SOURCE, path: str = DEFAULT_PATH, batch_size: int = 100_000) -> None:
+    """ Converts the JSON job list at `source` into a manifest stored in the directory `path`, `batch_size` shards at a time. """
+    os.makedirs(path, exist_ok=True)
+    files = {name: open(os.path.join(path, name), "wb") for name in ["start_id.bin", "end_id.bin", "shard.bin", "url_index.bin", "urls.bin", "url_offsets.bin"]}
+
+    count = 0
+    urls = 0
+    offset = 0
+    last_url = None
+    batch = {"start_id": [], "end_id": [], "shard": [], "url_index": [], "url_offsets": []}
+
+    def _flush():
+        np.array(batch["start_id"], dtype=np.int64).tofile(files["start_id.bin"])
+        np.array(batch["end_id"], dtype=np.int64).tofile(files["end_id.bin"])
+        np.array(batch["shard"], dtype=np.uint8).tofile(files["shard.bin"])
+        np.array(batch["url_index"], dtype=np.uint32).tofile(files["url_index.bin"])
+        np.array(batch["url_offsets"], dtype=np.int64).tofile(files["url_offsets.bin"])
+        for values in batch.values():
+            values.clear()
+
+    try:
+        batch["url_offsets"].append(0)
+
+        for job in iter_json_array(source):
+            # Both shards of a chunk are stored next to each other, so only consecutive duplicate URLs need to be interned.
+            if job["url"] != last_url:
+                data = job["url"].encode()
+                files["urls.bin"].write(data)
+                offset += len(data)
+                batch["url_offsets"].append(offset)
+                last_url = job["url"]
+                urls += 1
+
+            batch["start_id"].append(int(job["start_id"]))
+            batch["end_id"].append(int(job["end_id"]))
+            batch["shard"].append(job["shard"])
+            batch["url_index"].append(urls - 1)
+            count += 1
+
+            if len(batch["start_id"]) >= batch_size:
+                _flush()
+                print(f"Converted {count:,} shards...")
+
+        _flush()
+    finally:
+        for f in files.values():
+            f.close()
+
+    with open(os.path.join(path, "manifest.json"), "w") as f:
+        json.dump({"count": count, "urls": urls}, f)
+
+    manifest = Manifest(path)
+    if not np.array_equal(manifest.numbers(), np.arange(1, count + 1)):
+        print("WARNING: the shards in the manifest are not stored in order of their shard number.")
+
+    print(f"Converted {count:,} shards ({urls:,} unique URLs) into {path}.")
+
+
+if __name__ == "__main__":
+    convert(*sys.argv[1:3])
@@ -0,0 +1,129 @@
+import asyncio
+from collections import defaultdict
+from aioredis.client import Redis
+
+# METRICS -----
+# Request, job claim and page cache metrics in the Prometheus text format, served at /metrics.
+# Each process counts locally and periodically adds its counts to a single Redis hash, so /metrics covers every uvicorn process.
+# Each field in the hash is a full series name (e.g. `crawlingathome_requests_total{method="GET",route="/",status="200"}`).
+
+# The upper bounds, in seconds, of the request latency histogram buckets.
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# The type and description of every metric exposed.
+METRICS = {
+    "crawlingathome_requests_total": ("counter", "The number of requests handled, by route and response status."),
+    "crawlingathome_request_duration_seconds": ("histogram", "The time taken to handle each request, by route."),
+    "crawlingathome_job_claims_total": ("counter", "The number of job claims, by how the job was found. (`none` counts claims that found no job, e.g. due to contention)"),
+    "crawlingathome_page_cache_total": ("counter", "The number of dashboard page lookups, by page and cache outcome. (hit/stale/miss)"),
+    "crawlingathome_jobs": ("gauge", "The number of jobs in each state."),
+    "crawlingathome_clients": ("gauge", "The number of connected clients of each type."),
+    "crawlingathome_upload_workers": ("gauge", "The number of workers assigned to each upload address.")
+}
+
+
+def _series(name, labels) -> str:
+    """ Returns the series name of the metric `name` with the labels `labels`. """
+    if not labels:
+        return name
+    
+    values = ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels.items()
+    )
+    return name + "{" + values + "}"
+
+
+def _name(series) -> str:
+    """ Returns the name of the metric the series `series` belongs to. """
+    name = series.partition("{")[0]
+    for suffix in ["_bucket", "_sum", "_count"]:
+        if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+            return name[:-len(suffix)]
+    return name
+
+
+def _sort_key(series):
+    """ Returns the key used to sort the series `series`, which keeps the buckets of each histogram in order of their upper bound. """
+    head, _, le = series.partition(',le="')
+    if not le:
+        return (series, 0)
+    
+    le = le.rstrip('"}')
+    return (head, float("inf") if le == "+Inf" else float(le))
+
+
+class Metrics:
+    def __init__(self, client: Redis):
+        """ Counts metrics in this process, and adds them to the shared counts in Redis each time they are flushed. """
+        self._redis = client
+        self._counts = defaultdict(float)
+    
+    def incr(self, name, labels=None, amount=1) -> None:
+        """ Increments the counter `name` with the labels `labels` by `amount`. """
+        self._counts[_series(name, labels)] += amount
+    
+    def observe(self, name, labels, value) -> None:
+        """ Records `value` in the histogram `name` with the labels `labels`. """
+        # Every bucket is counted, even if empty, as Prometheus expects each histogram to have the same buckets.
+        for bound in LATENCY_BUCKETS:
+            self._counts[_series(name + "_bucket", {**labels, "le": bound})] += value <= bound
+        
+        self._counts[_series(name + "_bucket", {**labels, "le": "+Inf"})] += 1
+        self._counts[_series(name + "_sum", labels)] += value
+        self._counts[_series(name + "_count", labels)] += 1
+    
+    def request(self, method, route, status, duration) -> None:
+        """ Records a request to the route `route` which took `duration` seconds and responded with the status code `status`. """
+        self.incr("crawlingathome_requests_total", {"method": method, "route": route, "status": status})
+        self.observe("crawlingathome_request_duration_seconds", {"method": method, "route": route}, duration)
+    
+    async def flush(self) -> None:
+        """ Adds the counts since the last flush to the shared counts in Redis. """
+        counts, self._counts = self._counts, defaultdict(float)
+        if not counts:
+            return
+        
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                for series, amount in counts.items():
+                    pipe.hincrbyfloat("metrics", series, amount)
+                await pipe.execute()
+        except Exception:
+            # The counts are kept until the next flush, rather than being lost.
+            for series, amount in counts.items():
+                self._counts[series] += amount
+            raise
+    
+    async def run(self, interval) -> None:
+        """ Flushes the counts in this process every `interval` seconds. """
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await self.flush()
+                except Exception:
+                    pass # The counts are kept, and retried on the next flush.
+        finally:
+            await self.flush()
+    
+    async def render(self, gauges=None) -> str:
+        """ Returns the shared counts, along with the current values of the gauges `gauges` ({series: value}), in the Prometheus text format. """
+        series = {
+            key.decode(): value.decode()
+            for key, value in (await self._redis.hgetall("metrics")).items()
+        }
+        series.update((key, str(value)) for key, value in (gauges or {}).items())
+        
+        grouped = defaultdict(list)
+        for key in sorted(series, key=_sort_key):
+            grouped[_name(key)].append(key)
+        
+        lines = []
+        for name, keys in grouped.items():
+            type, description = METRICS.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {type}")
+            lines.extend(f"{key} {series[key]}" for key in keys)
+        
+        return "\n".join(lines) + "\n"
@@ -25,12 +25,16 @@ class Job(Model):
     
     # GPU job information (not always used)
     gpu = fields.BooleanField()
-    gpu_url = fields.CharField(max_length=500, null=True)
+    gpu_url = fields.CharField(max_length=500, null=True) # (indexed in `CUSTOM_QUERY_INDEXES`)
     
     # Contains information about the shard's completion.
     pending = fields.BooleanField()
     closed = fields.BooleanField()
     
+    # The time the worker processing this shard must next report progress by, after which the shard is returned to the pool.
+    # (only set whilst the shard is assigned to a worker - jobs reserved in the job queues have no lease)
+    lease_expires = fields.IntField(null=True) # (indexed in `CUSTOM_QUERY_INDEXES`)
+    
     # User data
     completor = fields.CharField(max_length=255, null=True) # Initially contains the worker's token whilst being processed, but contains the user's nickname on completion.
     cpu_completor = fields.CharField(max_length=255, null=True) # (contains the CPU worker's user nickname on completion if this shard was also processed using a CPU worker)
@@ -62,6 +66,7 @@ class Client(Model):
     user_nickname = fields.CharField(max_length=255)
     
     # The shard this client is currently processing.
+    # (jobs claimed in bulk using /api/newJobs are instead tracked as pending jobs with the client's UUID as their completor)
     shard = fields.ForeignKeyField("models.Job", related_name="worker", null=True)
     
     # Progress information sent from the client. ( client.log(...) )
@@ -74,6 +79,10 @@ class Client(Model):
     first_seen = fields.IntField()
     last_seen = fields.IntField()
     
+    class Meta:
+        # Used to list the workers of each type in order of connection. (see /api/workers)
+        indexes = (("type", "first_seen", "uuid"),)
+    
     def __str__(self):
         return self.type + " Client with UUID " + self.uuid
 
@@ -102,30 +111,351 @@ class CPU_Leaderboard(Model):
     
 # CUSTOM SQL QUERIES:
 
+# Jobs are claimed by scanning the partial indexes below from a random starting shard number,
+# wrapping around to the start of the table if nothing is open past that point. Each subquery
+# is an index range scan which stops at the first unlocked row, so claiming a job costs O(log n)
+# regardless of how many jobs are in the table. (unlike ORDER BY RANDOM(), which sorts every row)
+
+# Jobs reserved in advance for the Redis job queues are marked as pending with this completor.
+QUEUE_COMPLETOR = "[queued]"
+
+CUSTOM_QUERY_INDEXES = """
+CREATE INDEX IF NOT EXISTS "job_open_cpu_idx" ON "job" ("number") WHERE pending=false AND closed=false AND gpu=false;
+CREATE INDEX IF NOT EXISTS "job_open_gpu_idx" ON "job" ("number") WHERE pending=false AND closed=false AND gpu=true;
+CREATE INDEX IF NOT EXISTS "job_open_cpu_url_idx" ON "job" ("url") WHERE pending=false AND closed=false AND gpu=false;
+CREATE INDEX IF NOT EXISTS "job_pending_idx" ON "job" ("completor") WHERE pending=true;
+CREATE INDEX IF NOT EXISTS "job_gpu_url_idx" ON "job" ("gpu_url");
+CREATE INDEX IF NOT EXISTS "job_lease_idx" ON "job" ("lease_expires") WHERE pending=true;
+"""
+
 CUSTOM_QUERY_GPU = """
+WITH "start" AS (
+    SELECT FLOOR(RANDOM() * (MAX("number") + 1))::int AS "number" FROM "job"
+)
 UPDATE "job" 
-SET pending=true, completor='{}' 
-WHERE "number" IN 
+SET pending=true, completor='{}', lease_expires=NULL 
+WHERE "number" = COALESCE(
     (
      SELECT "number" FROM "job" 
      WHERE pending=false AND closed=false AND gpu=true 
-     ORDER BY RANDOM() LIMIT 1
+       AND "number" >= (SELECT "number" FROM "start")
+     ORDER BY "number" LIMIT 1
+     FOR UPDATE SKIP LOCKED
+    ),
+    (
+     SELECT "number" FROM "job" 
+     WHERE pending=false AND closed=false AND gpu=true 
+       AND "number" < (SELECT "number" FROM "start")
+     ORDER BY "number" LIMIT 1
      FOR UPDATE SKIP LOCKED
     )
+  )
   AND pending=false AND closed=false AND gpu=true
 ;
 """
 
 CUSTOM_QUERY_CPU_HYBRID = """
+WITH "start" AS (
+    SELECT FLOOR(RANDOM() * (MAX("number") + 1))::int AS "number" FROM "job"
+)
+UPDATE "job" 
+SET pending=true, completor='{}', lease_expires=NULL 
+WHERE "number" = COALESCE(
+    (
+     SELECT "number" FROM "job" 
+     WHERE pending=false AND closed=false AND gpu=false 
+       AND "number" >= (SELECT "number" FROM "start")
+     ORDER BY "number" LIMIT 1
+     FOR UPDATE SKIP LOCKED
+    ),
+    (
+     SELECT "number" FROM "job" 
+     WHERE pending=false AND closed=false AND gpu=false 
+       AND "number" < (SELECT "number" FROM "start")
+     ORDER BY "number" LIMIT 1
+     FOR UPDATE SKIP LOCKED
+    )
+  )
+  AND pending=false AND closed=false AND gpu=false
+;
+"""
+
+CUSTOM_QUERY_RESERVE_GPU = """
+UPDATE "job" 
+SET pending=true, completor=$1, lease_expires=$2::int 
+WHERE "number" IN 
+    (
+     SELECT "number" FROM "job" 
+     WHERE pending=false AND closed=false AND gpu=true 
+       AND "number" >= $3
+     ORDER BY "number" LIMIT $4
+     FOR UPDATE SKIP LOCKED
+    )
+  AND pending=false AND closed=false AND gpu=true
+RETURNING "number", "url", "gpu_url", "start_id", "end_id", "shard_of_chunk"
+;
+"""
+
+CUSTOM_QUERY_RESERVE_CPU_HYBRID = """
+UPDATE "job" 
+SET pending=true, completor=$1, lease_expires=$2::int 
+WHERE "number" IN 
+    (
+     SELECT "number" FROM "job" 
+     WHERE pending=false AND closed=false AND gpu=false 
+       AND "number" >= $3
+     ORDER BY "number" LIMIT $4
+     FOR UPDATE SKIP LOCKED
+    )
+  AND pending=false AND closed=false AND gpu=false
+RETURNING "number", "url", "gpu_url", "start_id", "end_id", "shard_of_chunk"
+;
+"""
+
+# Assigns a job popped from a job queue to a worker, starting its lease, in a single statement. Nothing is assigned if the job is no longer
+# reserved (e.g. its reservation was released whilst it was being popped), so a released job is never handed out twice.
+# Returns whether the worker exists, whether the job was claimed, and whether it was assigned to the worker. (a job claimed but not assigned
+# means the worker was deleted whilst it ran, and the transaction must be rolled back)
+
+CUSTOM_QUERY_ASSIGN_QUEUED = """
+WITH "claimed" AS (
+    UPDATE "job" 
+    SET completor=NULL, lease_expires=$4 
+    WHERE "number"=$2 AND pending=true AND completor=$3 
+      AND EXISTS (SELECT 1 FROM "client" WHERE "uuid"=$1) 
+    RETURNING "number"
+), "worker" AS (
+    UPDATE "client" 
+    SET shard_id="claimed"."number", progress='Recieved new job', last_seen=$5 
+    FROM "claimed" 
+    WHERE "client"."uuid"=$1 
+    RETURNING "client".shard_id
+)
+SELECT 
+    EXISTS (SELECT 1 FROM "client" WHERE "uuid"=$1) AS "worker", 
+    EXISTS (SELECT 1 FROM "claimed") AS "claimed", 
+    EXISTS (SELECT 1 FROM "worker") AS "assigned"
+;
+"""
+
+# Returns every job reserved for the job queues which is neither still queued ($2) nor assigned to a worker to the pool, e.g. after a crash.
+# The workers' shards are checked in the same statement, so a job popped from a queue and assigned after the queues were read is not released.
+# (and a job released just before being assigned is never handed out, see CUSTOM_QUERY_ASSIGN_QUEUED)
+
+CUSTOM_QUERY_RELEASE_ORPHANED = """
 UPDATE "job" 
-SET pending=true, completor='{}' 
+SET pending=false, completor=NULL, lease_expires=NULL 
+WHERE pending=true AND completor=$1 
+  AND NOT ("number" = ANY($2::int[])) 
+  AND NOT EXISTS (SELECT 1 FROM "client" WHERE "client".shard_id = "job"."number") 
+RETURNING gpu
+;
+"""
+
+# Claims every open CPU shard of a single chunk (WAT file), so the file is only downloaded once. The chunk is found the same way as
+# CUSTOM_QUERY_CPU_HYBRID, and its other shards are found using `job_open_cpu_url_idx`. Shards locked by another claim are skipped.
+# Jobs claimed this way are tracked like jobs claimed in bulk, with the worker's UUID as their completor.
+
+CUSTOM_QUERY_CPU_CHUNK = """
+WITH "start" AS (
+    SELECT FLOOR(RANDOM() * (MAX("number") + 1))::int AS "number" FROM "job"
+), "chunk" AS (
+    SELECT COALESCE(
+        (
+         SELECT "url" FROM "job" 
+         WHERE pending=false AND closed=false AND gpu=false 
+           AND "number" >= (SELECT "number" FROM "start")
+         ORDER BY "number" LIMIT 1
+         FOR UPDATE SKIP LOCKED
+        ),
+        (
+         SELECT "url" FROM "job" 
+         WHERE pending=false AND closed=false AND gpu=false 
+           AND "number" < (SELECT "number" FROM "start")
+         ORDER BY "number" LIMIT 1
+         FOR UPDATE SKIP LOCKED
+        )
+    ) AS "url"
+)
+UPDATE "job" 
+SET pending=true, completor=$1, lease_expires=$2 
 WHERE "number" IN 
     (
      SELECT "number" FROM "job" 
      WHERE pending=false AND closed=false AND gpu=false 
-     ORDER BY RANDOM() LIMIT 1
+       AND "url" = (SELECT "url" FROM "chunk")
      FOR UPDATE SKIP LOCKED
     )
   AND pending=false AND closed=false AND gpu=false
+RETURNING "number", "url", "start_id", "end_id", "shard_of_chunk"
+;
+"""
+
+CUSTOM_QUERY_COMPLETE_CPU = """
+UPDATE "job" 
+SET pending=false, completor=NULL, cpu_completor=$2, gpu_url="done"."gpu_url", 
+    gpu=("done"."gpu_url" NOT LIKE '%postgres%'), closed=("done"."gpu_url" LIKE '%postgres%') 
+FROM UNNEST($3::int[], $4::text[]) AS "done"("number", "gpu_url") 
+WHERE "job"."number" = "done"."number" 
+  AND "job".completor=$1 AND "job".pending=true AND "job".closed=false 
+RETURNING "job"."number", "job"."closed"
+;
+"""
+
+CUSTOM_QUERY_COMPLETE_GPU_HYBRID = """
+UPDATE "job" 
+SET pending=false, closed=true, completor=$2 
+WHERE "number" = ANY($3::int[]) 
+  AND completor=$1 AND pending=true AND closed=false 
+RETURNING "number"
+;
+"""
+
+# markAsDone is a single statement, so the job, client and leaderboard updates are applied in one transaction, and
+# the counters are incremented in the database to avoid losing updates when several workers complete jobs at once.
+
+CUSTOM_QUERY_MARK_DONE_CPU = """
+WITH "done" AS (
+    UPDATE "job" 
+    SET pending=false, cpu_completor=$2::text, gpu_url=$3::text, 
+        gpu=($3::text NOT LIKE '%postgres%'), closed=($3::text LIKE '%postgres%') 
+    WHERE "number" = (SELECT "shard_id" FROM "client" WHERE "uuid"=$1) 
+      AND pending=true AND closed=false 
+    RETURNING "number", "closed"
+), "worker" AS (
+    UPDATE "client" 
+    SET shard_id=NULL, progress='Completed Job', jobs_completed=jobs_completed + 1, last_seen=$4 
+    WHERE "uuid"=$1 AND EXISTS (SELECT 1 FROM "done")
+), "user" AS (
+    INSERT INTO "cpu_leaderboard" ("nickname", "jobs_completed") 
+    SELECT $2::text, 1 FROM "done" 
+    ON CONFLICT ("nickname") DO UPDATE 
+    SET jobs_completed = "cpu_leaderboard".jobs_completed + EXCLUDED.jobs_completed
+)
+SELECT "number", "closed" FROM "done"
+;
+"""
+
+CUSTOM_QUERY_MARK_DONE_GPU_HYBRID = """
+WITH "done" AS (
+    UPDATE "job" 
+    SET pending=false, closed=true, completor=$2 
+    WHERE "number" = (SELECT "shard_id" FROM "client" WHERE "uuid"=$1) 
+      AND closed=false 
+    RETURNING "number"
+), "worker" AS (
+    UPDATE "client" 
+    SET shard_id=NULL, progress='Completed Job', jobs_completed=jobs_completed + 1, last_seen=$4 
+    WHERE "uuid"=$1 AND EXISTS (SELECT 1 FROM "done")
+), "user" AS (
+    INSERT INTO "leaderboard" ("nickname", "jobs_completed", "pairs_scraped") 
+    SELECT $2, 1, $3 FROM "done" 
+    ON CONFLICT ("nickname") DO UPDATE 
+    SET jobs_completed = "leaderboard".jobs_completed + EXCLUDED.jobs_completed, 
+        pairs_scraped = "leaderboard".pairs_scraped + EXCLUDED.pairs_scraped
+)
+SELECT "number" FROM "done"
+;
+"""
+
+CUSTOM_QUERY_UPSERT_LEADERBOARD = """
+INSERT INTO "leaderboard" ("nickname", "jobs_completed", "pairs_scraped") 
+VALUES ($1, $2, $3) 
+ON CONFLICT ("nickname") DO UPDATE 
+SET jobs_completed = "leaderboard".jobs_completed + EXCLUDED.jobs_completed, 
+    pairs_scraped = "leaderboard".pairs_scraped + EXCLUDED.pairs_scraped
+;
+"""
+
+CUSTOM_QUERY_UPSERT_CPU_LEADERBOARD = """
+INSERT INTO "cpu_leaderboard" ("nickname", "jobs_completed") 
+VALUES ($1, $2) 
+ON CONFLICT ("nickname") DO UPDATE 
+SET jobs_completed = "cpu_leaderboard".jobs_completed + EXCLUDED.jobs_completed
+;
+"""
+
+# Returns the shard currently assigned to a worker to the pool, returning whether it was a GPU job.
+
+CUSTOM_QUERY_RELEASE_SHARD = """
+UPDATE "job" 
+SET pending=false, completor=NULL, lease_expires=NULL 
+WHERE "number" = (SELECT "shard_id" FROM "client" WHERE "uuid"=$1) 
+  AND pending=true 
+RETURNING gpu
+;
+"""
+
+# Deletes every idle client and releases the jobs they held, returning how much each live counter changed by and the deleted clients' UUIDs and display names.
+
+CUSTOM_QUERY_REAP_IDLE = """
+WITH "idle" AS (
+    DELETE FROM "client" 
+    WHERE last_seen <= $1 
+    RETURNING "uuid", "type", "display_name", "shard_id"
+), "released" AS (
+    UPDATE "job" 
+    SET pending=false, completor=NULL, lease_expires=NULL 
+    WHERE pending=true 
+      AND ("number" IN (SELECT "shard_id" FROM "idle") OR completor IN (SELECT "uuid" FROM "idle")) 
+    RETURNING gpu
+)
+SELECT 'clients:' || "type" AS "counter", COUNT(*) AS "count", ARRAY_AGG("uuid") AS "uuids", ARRAY_AGG("display_name") AS "names" FROM "idle" GROUP BY "type" 
+UNION ALL 
+SELECT CASE WHEN gpu THEN 'gpu' ELSE 'open' END, COUNT(*), NULL, NULL FROM "released" GROUP BY 1
+;
+"""
+
+# Writes a batch of buffered progress updates, skipping any older than the client's last update, and extends the lease on every job held by those clients.
+# Returns the updated clients, which are sent to the live dashboard.
+
+CUSTOM_QUERY_FLUSH_HEARTBEATS = """
+WITH "worker" AS (
+    UPDATE "client" 
+    SET progress="beat"."progress", last_seen="beat"."last_seen" 
+    FROM UNNEST($1::text[], $2::text[], $3::int[]) AS "beat"("uuid", "progress", "last_seen") 
+    WHERE "client"."uuid" = "beat"."uuid" AND "client".last_seen <= "beat"."last_seen" 
+    RETURNING "client"."uuid", "client"."type", "client"."display_name", "client"."shard_id", "client"."progress", "client"."last_seen"
+), "shard" AS (
+    UPDATE "job" 
+    SET lease_expires = "worker"."last_seen" + $4 
+    FROM "worker" 
+    WHERE "job"."number" = "worker"."shard_id" AND "job".pending=true
+), "bulk" AS (
+    UPDATE "job" 
+    SET lease_expires = "worker"."last_seen" + $4 
+    FROM "worker" 
+    WHERE "job".completor = "worker"."uuid" AND "job".pending=true
+)
+SELECT "type", "display_name", "progress", "last_seen" FROM "worker"
+;
+"""
+
+# Returns every job whose lease has expired to the pool, unassigning it from its worker, and returns how many were released from each state
+# along with the UUIDs of the unassigned workers.
+
+CUSTOM_QUERY_RELEASE_EXPIRED = """
+WITH "expired" AS (
+    UPDATE "job" 
+    SET pending=false, completor=NULL, lease_expires=NULL 
+    WHERE pending=true AND lease_expires < $1 
+    RETURNING "number", gpu
+), "worker" AS (
+    UPDATE "client" 
+    SET shard_id=NULL 
+    WHERE shard_id IN (SELECT "number" FROM "expired") 
+    RETURNING "uuid"
+)
+SELECT CASE WHEN gpu THEN 'gpu' ELSE 'open' END AS "state", COUNT(*) AS "count", (SELECT ARRAY_AGG("uuid") FROM "worker") AS "uuids" 
+FROM "expired" GROUP BY 1
+;
+"""
+
+CUSTOM_QUERY_COUNT_JOBS = """
+SELECT 
+    CASE WHEN closed THEN 'closed' WHEN pending THEN 'pending' WHEN gpu THEN 'gpu' ELSE 'open' END AS "state", 
+    COUNT(*) AS "count" 
+FROM "job" 
+GROUP BY "state"
 ;
 """
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # (the server loads words.json and its templates from the working directory)
+
+import config
+
+# The tests which need a database or Redis run against the scratch instances given by these environment variables, and are skipped otherwise.
+# IMPORTANT: Both are wiped by the tests, so never point them at a live server's database.
+TEST_SQL_CONN_URL = os.environ.get("TEST_SQL_CONN_URL") # e.g. "postgres:///crawlingathome_test" (Postgres only)
+TEST_REDIS_CONN_URL = os.environ.get("TEST_REDIS_CONN_URL") # e.g. "redis://127.0.0.1/15"
+
+# The server reads its config on import, so the scratch instances are set before any test imports it.
+if TEST_SQL_CONN_URL:
+    config.SQL_CONN_URL = TEST_SQL_CONN_URL
+if TEST_REDIS_CONN_URL:
+    config.REDIS_CONN_URL = TEST_REDIS_CONN_URL
+
+
+@pytest.fixture
+def server():
+    """ Returns the server module, skipping the test unless a scratch Redis instance is configured. """
+    if not TEST_REDIS_CONN_URL:
+        pytest.skip("TEST_REDIS_CONN_URL is not set.")
+    
+    import main
+    return main
+
+
+@pytest.fixture
+def database(server):
+    """ Returns the URL of the scratch database, skipping the test unless one is configured. """
+    if not TEST_SQL_CONN_URL:
+        pytest.skip("TEST_SQL_CONN_URL is not set.")
+    
+    return TEST_SQL_CONN_URL
@@ -0,0 +1,39 @@
+import json
+
+import pytest
+
+from manifest import iter_json_array
+
+ARRAYS = [
+    [],
+    [1, 2.5],
+    [-300000.0],
+    [0, -1, 12345678901234, 1.5e-7, -3E+12, 2.0, 10, "", "a, b", "[1, 2]", '"quoted" \\ path', True, False, None],
+    [{"url": "crawl-data/1.warc.wat.gz", "start_id": 0, "end_id": 1000000, "shard": 0}, {"url": "crawl-data/2.warc.wat.gz", "start_id": 1000000, "end_id": 2000000, "shard": 1}],
+    [[1, [2.25, "x"]], {"a": [-0.5]}, 7],
+]
+
+
+@pytest.mark.parametrize("items", ARRAYS)
+@pytest.mark.parametrize("indent", [None, 2])
+def test_iter_json_array_at_every_chunk_size(tmp_path, items, indent):
+    path = tmp_path / "original.json"
+    text = json.dumps(items, indent=indent)
+    path.write_text(text)
+    
+    # Every chunk size cuts the array at a different point, including in the middle of every number and string.
+    for chunk_size in range(1, len(text) + 2):
+        assert list(iter_json_array(path, chunk_size=chunk_size)) == items, chunk_size
+
+
+def test_iter_json_array_rejects_invalid_json(tmp_path):
+    path = tmp_path / "original.json"
+    
+    path.write_text('{"a": 1}')
+    with pytest.raises(ValueError):
+        list(iter_json_array(path))
+    
+    path.write_text("[1, 2.]")
+    for chunk_size in [1, 3, 100]:
+        with pytest.raises(ValueError):
+            list(iter_json_array(path, chunk_size=chunk_size))
@@ -0,0 +1,54 @@
+import asyncio
+
+import httpx
+import pytest
+from tortoise import Tortoise
+
+from models import Job, Client, Leaderboard, CPU_Leaderboard
+
+# The number of workers completing a job at the same time.
+WORKERS = 20
+
+
+async def _mark_as_done_concurrently(main, db_url, type):
+    await Tortoise.init(db_url=db_url, modules={"models": ["models"]})
+    try:
+        await Tortoise.generate_schemas()
+        await Tortoise.get_connection("default").execute_script('DELETE FROM "client"; DELETE FROM "job"; DELETE FROM "leaderboard"; DELETE FROM "cpu_leaderboard";')
+        
+        # Every worker belongs to the same user, and holds its own pending job.
+        await Job.bulk_create([
+            Job(number=i, url=f"{i}.warc.wat.gz", start_id="0", end_id="0", shard_of_chunk=0, gpu=type == "GPU", gpu_url=f"{i}.tar", pending=True, closed=False)
+            for i in range(WORKERS)
+        ])
+        await Client.bulk_create([
+            Client(uuid=f"test-{type}-{i}", display_name=f"test-{i}", type=type, user_nickname="test", shard_id=i,
+                   progress="Initialized", jobs_completed=0, first_seen=0, last_seen=0)
+            for i in range(WORKERS)
+        ])
+        
+        body = {"url": "done.tar"} if type == "CPU" else {"count": 10}
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as http:
+            responses = await asyncio.gather(*[
+                http.post("/api/markAsDone", json={"token": f"test-{type}-{i}", "type": type, **body})
+                for i in range(WORKERS)
+            ])
+        
+        assert [r.status_code for r in responses] == [200] * WORKERS
+        
+        if type == "CPU":
+            user = await CPU_Leaderboard.get(nickname="test")
+        else:
+            user = await Leaderboard.get(nickname="test")
+            assert user.pairs_scraped == 10 * WORKERS
+        assert user.jobs_completed == WORKERS
+        
+        assert await Job.filter(pending=True).count() == 0
+        assert await Client.filter(jobs_completed=1, shard_id=None).count() == WORKERS
+    finally:
+        await Tortoise.close_connections()
+
+
+@pytest.mark.parametrize("type", ["CPU", "GPU"])
+def test_concurrent_mark_as_done_loses_no_updates(server, database, type):
+    asyncio.run(_mark_as_done_concurrently(server, database, type))
@@ -0,0 +1,134 @@
+import asyncio
+import json
+
+# The polling intervals used in the tests. (sleeps are recorded rather than waited for, so only the timeout is real)
+INTERVAL, MAX_BACKOFF, TIMEOUT = 1, 4, 0.2
+
+
+class StubServer:
+    def __init__(self, script):
+        """ A local HTTP server standing in for NOLANG_PAIRS_URL, which answers each request with the next step of `script`:
+        ("ok", count) responds with the pairs count, ("error",) with a 500, and ("hang",) never responds. """
+        self.script = list(script)
+        self.requests = 0
+    
+    async def _handle(self, reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        self.requests += 1
+        step = self.script.pop(0) if self.script else ("hang",)
+        
+        if step[0] == "hang":
+            await reader.read() # (until the client gives up and closes the connection)
+        elif step[0] == "ok":
+            body = json.dumps({"Number of items inserted": step[1]}).encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+        else:
+            writer.write(b"HTTP/1.1 500 Internal Server Error\r\nConnection: close\r\nContent-Length: 0\r\n\r\n")
+        
+        writer.close()
+    
+    async def start(self) -> str:
+        """ Starts the server, returning its URL. """
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return f"http://127.0.0.1:{self._server.sockets[0].getsockname()[1]}/info/?key=nolang"
+    
+    def close(self):
+        self._server.close()
+
+
+async def _poll(main, monkeypatch, script, polls):
+    """ Runs `update_pairs_count` against a stub server following `script` until it has slept `polls` times,
+    returning the delays it slept for and the nolang pairs count it stored before each request. """
+    await main.cache.client.delete("pairs", "ml-pairs", "nl-pairs")
+    
+    stub = StubServer(script)
+    monkeypatch.setattr(main, "NOLANG_PAIRS_URL", await stub.start())
+    
+    stored, delays = [], []
+    sleep = asyncio.sleep
+    
+    async def _record_sleep(delay, *args, **kwargs):
+        delays.append(delay)
+        stored.append(await main.cache.client.get("nl-pairs"))
+        await sleep(0)
+    
+    monkeypatch.setattr(main.asyncio, "sleep", _record_sleep)
+    
+    task = asyncio.create_task(main.update_pairs_count())
+    try:
+        for _ in range(200):
+            if len(delays) >= polls or task.done():
+                break
+            await sleep(0.05)
+        
+        assert not task.done(), task.exception()
+        assert len(delays) >= polls
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        monkeypatch.setattr(main.asyncio, "sleep", sleep)
+        stub.close()
+    
+    return delays[:polls], [None if value is None else int(value) for value in stored[:polls]]
+
+
+def _configure(main, monkeypatch):
+    monkeypatch.setattr(main, "PAIRS_POLL_INTERVAL", INTERVAL)
+    monkeypatch.setattr(main, "PAIRS_POLL_MAX_BACKOFF", MAX_BACKOFF)
+    monkeypatch.setattr(main, "PAIRS_POLL_TIMEOUT", TIMEOUT)
+
+
+def test_backs_off_and_keeps_the_last_known_good_count(server, monkeypatch):
+    _configure(server, monkeypatch)
+    
+    async def _test():
+        script = [("ok", 100), ("error",), ("error",), ("hang",), ("error",), ("ok", 200)]
+        delays, stored = await _poll(server, monkeypatch, script, len(script))
+        
+        # Each failure (including the timeout) doubles the delay up to the maximum, and a success resets it.
+        assert delays == [INTERVAL, 2, 4, MAX_BACKOFF, MAX_BACKOFF, INTERVAL]
+        assert stored == [100, 100, 100, 100, 100, 200]
+        
+        assert int(await server.cache.client.get("pairs")) == 2323000000
+        assert int(await server.cache.client.get("ml-pairs")) == 2381000000
+    
+    asyncio.run(_test())
+
+
+def test_times_out_a_hanging_source(server, monkeypatch):
+    _configure(server, monkeypatch)
+    
+    async def _test():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        delays, stored = await _poll(server, monkeypatch, [("hang",), ("ok", 300)], 2)
+        
+        assert delays == [2, INTERVAL]
+        assert stored == [None, 300]
+        assert loop.time() - start < TIMEOUT + 5
+    
+    asyncio.run(_test())
+
+
+def test_survives_redis_errors(server, monkeypatch):
+    _configure(server, monkeypatch)
+    
+    async def _test():
+        mset = server.cache.client.mset
+        failures = [ConnectionError("Redis is unavailable.")]
+        
+        async def _failing_mset(*args, **kwargs):
+            if failures:
+                raise failures.pop()
+            return await mset(*args, **kwargs)
+        
+        monkeypatch.setattr(server.cache.client, "mset", _failing_mset)
+        
+        # The first poll fails before reaching the source, and is retried after backing off.
+        delays, stored = await _poll(server, monkeypatch, [("ok", 400)], 2)
+        
+        assert delays == [2, INTERVAL]
+        assert stored == [None, 400]
+        assert int(await server.cache.client.get("pairs")) == 2323000000
+    
+    asyncio.run(_test())
@@ -1,19 +1,203 @@
 from tortoise import Tortoise, run_async
 from config import SQL_CONN_URL
 from models import *
+from manifest import Manifest, convert, iter_json_array, shard_numbers, DEFAULT_PATH as MANIFEST_PATH
+from time import perf_counter
+from hashlib import md5
 import numpy as np
 import json
-import gc
+import sys
+import os
 
 # JSON -> SQL CONVERTER SCRIPT -----
 # You need a fresh `open.json` file named `original.json` stored in the jobs folder. (don't delete the existing open.json file)
+# `original.json` is converted into a memory-mapped job manifest (see manifest.py) the first time this script is run.
 # You need your SQL database set up, and configured in config.py
+# The JSON files are streamed and written in batches, so memory use does not depend on the number of shards.
+# If the script is interrupted, simply run it again to resume from the last batch written. (progress is stored in `CHECKPOINT_FILE`)
 
-def _calculate_shard_number(job):
-    count = (np.int64(job["end_id"]) / 1000000) * 2
-    if job["shard"] == 0:
-        count -= 1
-    return int(count)
+BATCH_SIZE = 50_000
+CHECKPOINT_FILE = "jobs/import_checkpoint.json"
+
+# Job states used while streaming the JSON files. (a shard keeps the first state it is given, matching the old dedupe order)
+ABSENT, OPEN, CLOSED, GPU = 0, 1, 2, 3
+
+JOB_COLUMNS = ["number", "url", "start_id", "end_id", "shard_of_chunk", "gpu", "gpu_url", "pending", "closed", "completor", "cpu_completor"]
+GPU_COLUMNS = ["gpu_url", "start_id", "end_id", "shard_of_chunk"]
+
+QUERY_UPDATE_GPU = """
+UPDATE "job"
+SET gpu_url="gpu"."gpu_url", start_id="gpu"."start_id", end_id="gpu"."end_id", shard_of_chunk="gpu"."shard_of_chunk"
+FROM UNNEST($1::int[], $2::text[], $3::text[], $4::text[], $5::int[]) AS "gpu"("number", "gpu_url", "start_id", "end_id", "shard_of_chunk")
+WHERE "job"."number" = "gpu"."number"
+;
+"""
+
+# INCREMENTAL SYNC (python update_db.py --sync) -----
+# Compares the jobs in the manifest against the `job` table in ranges of `SYNC_RANGE_SIZE` shard numbers, using checksums of the job data,
+# and only reads and writes the ranges which have changed. Only jobs which are neither pending nor assigned to a worker are changed or deleted,
+# and jobs are only ever moved forward from open -> GPU -> closed, so this can be run on a live server. (Postgres only)
+# The job data of GPU and closed jobs is never changed, as GPU jobs hold the GPU-specific data written from `open_gpu.json` instead.
+
+SYNC_RANGE_SIZE = 10_000
+
+QUERY_RANGE_CHECKSUMS = """
+SELECT "number" / $1 AS "range", md5(string_agg("number" || ':' || url || ':' || start_id || ':' || end_id || ':' || shard_of_chunk, ',' ORDER BY "number")) AS "checksum"
+FROM "job"
+GROUP BY 1
+;
+"""
+
+QUERY_RANGE_JOBS = """
+SELECT "number", url, start_id, end_id, shard_of_chunk
+FROM "job"
+WHERE "number" >= $1 AND "number" < $2
+;
+"""
+
+QUERY_SYNC_UPDATE = """
+UPDATE "job"
+SET url="new"."url", start_id="new"."start_id", end_id="new"."end_id", shard_of_chunk="new"."shard_of_chunk"
+FROM UNNEST($1::int[], $2::text[], $3::text[], $4::text[], $5::int[]) AS "new"("number", "url", "start_id", "end_id", "shard_of_chunk")
+WHERE "job"."number" = "new"."number" AND "job".gpu=false AND "job".pending=false AND "job".closed=false
+  AND NOT EXISTS (SELECT 1 FROM "client" WHERE "client".shard_id = "job"."number")
+RETURNING "job"."number"
+;
+"""
+
+QUERY_SYNC_DELETE = """
+DELETE FROM "job"
+WHERE "number" = ANY($1::int[]) AND pending=false
+  AND NOT EXISTS (SELECT 1 FROM "client" WHERE "client".shard_id = "job"."number")
+RETURNING "number"
+;
+"""
+
+QUERY_SYNC_CLOSE = """
+UPDATE "job"
+SET closed=true, completor='N/A'
+WHERE "number" = ANY($1::int[]) AND closed=false AND pending=false
+RETURNING "number"
+;
+"""
+
+QUERY_SYNC_GPU = """
+UPDATE "job"
+SET gpu=true, gpu_url="gpu"."gpu_url", cpu_completor='N/A'
+FROM UNNEST($1::int[], $2::text[]) AS "gpu"("number", "gpu_url")
+WHERE "job"."number" = "gpu"."number" AND "job".closed=false AND "job".pending=false AND ("job".gpu=false OR "job".gpu_url IS NULL)
+RETURNING "job"."number"
+;
+"""
+
+def _batches(items, size=BATCH_SIZE):
+    """ Yields lists of up to `size` items from `items`. """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _load_checkpoint():
+    if not os.path.exists(CHECKPOINT_FILE):
+        return None
+    with open(CHECKPOINT_FILE, "r") as f:
+        return json.load(f)
+
+def _save_checkpoint(stage, number=0):
+    # Written to a temporary file first, so a crash never leaves a half-written checkpoint.
+    with open(CHECKPOINT_FILE + ".tmp", "w") as f:
+        json.dump({"stage": stage, "number": number}, f)
+    os.replace(CHECKPOINT_FILE + ".tmp", CHECKPOINT_FILE)
+
+async def _write_jobs(conn, rows):
+    """ Inserts a batch of job rows, using `COPY` on Postgres (asyncpg) and a bulk insert (executemany) on other databases. """
+    async with conn.acquire_connection() as connection:
+        if hasattr(connection, "copy_records_to_table"):
+            await connection.copy_records_to_table("job", records=rows, columns=JOB_COLUMNS)
+            return
+
+    await Job.bulk_create([Job(**dict(zip(JOB_COLUMNS, row))) for row in rows])
+
+async def _write_gpu_jobs(conn, rows):
+    """ Sets the GPU job data of a batch of jobs. """
+    if conn.capabilities.dialect == "postgres":
+        await conn.execute_query(QUERY_UPDATE_GPU, [list(column) for column in zip(*rows)])
+    else:
+        await Job.bulk_update([Job(**dict(zip(["number"] + GPU_COLUMNS, row))) for row in rows], fields=GPU_COLUMNS)
+
+def _load_states(total_shards):
+    """ Returns the state of every shard number, from `open.json`, `closed.json` and `open_gpu.json`. """
+    # The state of every shard number is tracked in a single byte each. (~8.5MB for the full dataset)
+    states = np.zeros(total_shards + 1, dtype=np.uint8)
+
+    def _mark(numbers, state):
+        nonlocal states
+        if len(numbers) and numbers.max() >= len(states):
+            states = np.concatenate([states, np.zeros(numbers.max() + 1 - len(states), dtype=np.uint8)])
+
+        # Every shard in a batch is given the same state, so shards listed more than once still keep their first state.
+        numbers = numbers[states[numbers] == ABSENT]
+        states[numbers] = state
+
+    for jobs in _batches(iter_json_array("jobs/open.json")):
+        _mark(shard_numbers([job["end_id"] for job in jobs], [job["shard"] for job in jobs]), OPEN)
+    for closed in _batches(iter_json_array("jobs/closed.json")):
+        _mark(np.array([int(number) for number in closed], dtype=np.int64), CLOSED)
+    for gpu_jobs in _batches(iter_json_array("jobs/open_gpu.json")):
+        _mark(np.array([int(data[0]) for data in gpu_jobs], dtype=np.int64), GPU)
+
+    return states
+
+def _load_manifest():
+    """ Returns the job manifest, converting `original.json` into it first if it is missing or out of date. """
+    info = os.path.join(MANIFEST_PATH, "manifest.json")
+    if not os.path.exists(info) or (os.path.exists("jobs/original.json") and os.path.getmtime(info) < os.path.getmtime("jobs/original.json")):
+        print("Converting original.json into a job manifest...")
+        convert()
+    return Manifest()
+
+def _job_numbers(manifest, states):
+    """ Returns the sorted shard numbers of every job which should be in the database. """
+    # Row `i` of the manifest contains shard number `i + 1`, so any shard number outside of it has no job data.
+    numbers = np.flatnonzero(states[:len(manifest) + 1])
+    missing = int(np.count_nonzero(states[len(manifest) + 1:]))
+    if missing:
+        print(f"WARNING: {missing:,} shards are not in original.json, and will be skipped.")
+    return numbers
+
+def _job_rows(manifest, directory, states, numbers):
+    """ Returns the rows (in the order of `JOB_COLUMNS`) of the jobs with shard numbers `numbers`. """
+    return [
+        (
+            number,
+            directory + manifest.url(url),
+            str(start_id),
+            str(end_id),
+            shard,
+            state == GPU,
+            None, # (GPU job data is filled in from `open_gpu.json` afterwards)
+            False,
+            state == CLOSED,
+            "N/A" if state == CLOSED else None,
+            "N/A" if state == GPU else None
+        )
+        for number, url, start_id, end_id, shard, state in zip(
+            numbers.tolist(),
+            manifest.url_index[numbers - 1].tolist(),
+            manifest.start_id[numbers - 1].tolist(),
+            manifest.end_id[numbers - 1].tolist(),
+            manifest.shard[numbers - 1].tolist(),
+            states[numbers].tolist()
+        )
+    ]
+
+def _checksum(rows):
+    """ Returns the checksum of a range of job rows, matching `QUERY_RANGE_CHECKSUMS`. """
+    return md5(",".join(f"{row[0]}:{row[1]}:{row[2]}:{row[3]}:{row[4]}" for row in rows).encode()).hexdigest()
 
 async def init():
     # 0. Connect to DB
@@ -24,124 +208,228 @@ async def init():
     )
 
     await Tortoise.generate_schemas()
-    
-    
+    conn = Tortoise.get_connection("default")
+
+    checkpoint = _load_checkpoint()
+    if checkpoint is None:
+        if await Job.all().count() > 0:
+            print("The `job` table is not empty and there is no checkpoint to resume from - refusing to overwrite it.")
+            return
+        checkpoint = {"stage": "jobs", "number": 0}
+    elif checkpoint["stage"] == "done":
+        print(f"The database has already been set up. (delete {CHECKPOINT_FILE} to run the import again)")
+        return
+    else:
+        print(f"Resuming from checkpoint: {checkpoint}")
+
+
     # 1. Jobs
     print("Processing jobs... (this may take a while)")
     with open("jobs/shard_info.json", "r") as f:
-        directory = json.load(f)["directory"]
-    with open("jobs/original.json", "r") as f:
-        db = json.load(f)
-    with open("jobs/open.json", "r") as f:
-        opened = [_calculate_shard_number(i) for i in json.load(f)] 
-    with open("jobs/closed.json", "r") as f:
-        closed = [int(i) for i in json.load(f)]
-    with open("jobs/open_gpu.json", "r") as f:
-        gpu_data = json.load(f)
-    
-    jobs = []
-    
-    for i in opened:
-        data = db[i-1]
-        job = Job(
-            number=i,
-            url=directory + data["url"],
-            start_id=data["start_id"],
-            end_id=data["end_id"],
-            shard_of_chunk=data["shard"],
-            gpu=False,
-            gpu_url=None,
-            pending=False,
-            closed=False,
-            completor=None,
-            cpu_completor=None
-        )
-        
-        jobs.append(job)
-    
-    for i in closed:
-        data = db[i-1]
-        job = Job(
-            number=i,
-            url=directory + data["url"],
-            start_id=data["start_id"],
-            end_id=data["end_id"],
-            shard_of_chunk=data["shard"],
-            gpu=False,
-            gpu_url=None,
-            pending=False,
-            closed=True,
-            completor="N/A",
-            cpu_completor=None
-        )
-        
-        jobs.append(job)
-    
-    for data in gpu_data:
-        number = int(data[0])
-        job = Job(
-            number=number,
-            url=directory + db[number-1]["url"],
-            start_id=data[1]["start_id"],
-            end_id=data[1]["end_id"],
-            shard_of_chunk=data[1]["shard"],
-            gpu=True,
-            gpu_url=data[1]["url"],
-            pending=False,
-            closed=False,
-            completor=None,
-            cpu_completor="N/A"
-        )
-        
-        jobs.append(job)
-    
-    # Dedupe
-    seen = set()
-    new_jobs = []
-    for job in jobs:
-        if job.number not in seen:
-            new_jobs.append(job)
-            seen.add(job.number)
-    jobs = new_jobs
-    
-    jobs = sorted(jobs, key=lambda x: x.number) # Sort
-    
-    
-    print("Bulk creating jobs in database... (this may take a while)")
-    await Job.bulk_create(jobs)
-    
-    del db, opened, closed, gpu_data, jobs
-    gc.collect()
-    
-    
+        shard_info = json.load(f)
+    directory = shard_info["directory"]
+
+    states = _load_states(shard_info["total_shards"])
+
+    if checkpoint["stage"] == "jobs":
+        manifest = _load_manifest()
+        numbers = _job_numbers(manifest, states)
+        total = len(numbers)
+        print(f"Found {total:,} jobs to import.")
+
+        # Remove anything written after the last checkpoint, as the batch may not have been recorded.
+        await Job.filter(number__gt=checkpoint["number"]).delete()
+        numbers = numbers[numbers > checkpoint["number"]]
+
+        print("Bulk creating jobs in database... (this may take a while)")
+        start = perf_counter()
+        resumed = total - len(numbers)
+        inserted = resumed
+
+        # Jobs are inserted in order of their shard number.
+        for i in range(0, len(numbers), BATCH_SIZE):
+            rows = _job_rows(manifest, directory, states, numbers[i:i + BATCH_SIZE])
+            await _write_jobs(conn, rows)
+            _save_checkpoint("jobs", rows[-1][0])
+            inserted += len(rows)
+            print(f"Inserted {inserted:,} / {total:,} jobs ({(inserted - resumed) / (perf_counter() - start):,.0f} jobs/s)")
+
+        _save_checkpoint("gpu")
+        checkpoint = {"stage": "gpu", "number": 0}
+
+    if checkpoint["stage"] == "gpu":
+        print("Setting GPU job data...")
+
+        # Only the first entry for each GPU job is used, matching the old dedupe order. (this step can safely be re-run)
+        applied = np.zeros(len(states), dtype=bool)
+        updated = 0
+        rows = []
+
+        for data in iter_json_array("jobs/open_gpu.json"):
+            number = int(data[0])
+            if states[number] != GPU or applied[number]:
+                continue
+
+            applied[number] = True
+            rows.append((number, data[1]["url"], str(data[1]["start_id"]), str(data[1]["end_id"]), data[1]["shard"]))
+
+            if len(rows) >= BATCH_SIZE:
+                await _write_gpu_jobs(conn, rows)
+                updated += len(rows)
+                rows = []
+                print(f"Updated {updated:,} GPU jobs")
+
+        if rows:
+            await _write_gpu_jobs(conn, rows)
+            updated += len(rows)
+            print(f"Updated {updated:,} GPU jobs")
+
+        _save_checkpoint("indexes")
+        checkpoint = {"stage": "indexes", "number": 0}
+
+    del states
+
+    if checkpoint["stage"] == "indexes":
+        # The partial indexes used to claim jobs are built after the bulk insert, as this is much faster.
+        print("Creating job indexes...")
+        await conn.execute_script(CUSTOM_QUERY_INDEXES)
+
+        _save_checkpoint("leaderboard")
+        checkpoint = {"stage": "leaderboard", "number": 0}
+
+
     # 2. Leaderboard
     print("Processing leaderboard...")
     with open("jobs/leaderboard.json", "r") as f:
         lb = json.load(f)
-    
+
     leaderboard = []
-    
+
     for user in lb:
         userboard = Leaderboard(
             nickname=user,
             jobs_completed=lb[user][0],
             pairs_scraped=lb[user][1]
         )
-        
+
         leaderboard.append(userboard)
-    
+
     print("Bulk creating leaderboard in database... (this may take a while)")
+    await Leaderboard.all().delete()
     await Leaderboard.bulk_create(leaderboard)
-    
-    del lb, leaderboard
-    gc.collect()
-    
-    
+
+    _save_checkpoint("done")
+
+
     # We don't need to do Client as they are volatile
     # We don't need to do CPU_Leaderboard as it did not exist before v3.0.0
-    
+
+    print("Done.")
+
+
+
+async def sync():
+    print("Connecting to DB using url from config.py...")
+    await Tortoise.init(
+        db_url=SQL_CONN_URL,
+        modules={'models': ['models']}
+    )
+    conn = Tortoise.get_connection("default")
+
+    if conn.capabilities.dialect != "postgres":
+        print("Incremental sync is only supported on Postgres.")
+        return
+
+    print("Processing jobs...")
+    with open("jobs/shard_info.json", "r") as f:
+        shard_info = json.load(f)
+    directory = shard_info["directory"]
+
+    states = _load_states(shard_info["total_shards"])
+    manifest = _load_manifest()
+    numbers = _job_numbers(manifest, states)
+
+    # 1. Find the ranges of shard numbers which differ between the manifest and the database.
+    print("Comparing checksums...")
+    start = perf_counter()
+    existing = {row["range"]: row["checksum"] for row in await conn.execute_query_dict(QUERY_RANGE_CHECKSUMS, [SYNC_RANGE_SIZE])}
+
+    ranges = numbers // SYNC_RANGE_SIZE
+    bounds = np.flatnonzero(np.diff(ranges)) + 1
+    changed = set(existing) - set(ranges.tolist()) # (ranges with no jobs left in the manifest)
+
+    for batch in np.split(numbers, bounds):
+        if len(batch) == 0:
+            continue
+        range_id = int(batch[0]) // SYNC_RANGE_SIZE
+        if existing.get(range_id) != _checksum(_job_rows(manifest, directory, states, batch)):
+            changed.add(range_id)
+
+    print(f"{len(changed):,} / {len(set(existing) | set(ranges.tolist())):,} ranges have changed. ({perf_counter() - start:.1f}s)")
+
+    # 2. Diff the changed ranges row by row, applying the changes in batches.
+    inserts, updates, deletes = [], [], []
+    inserted, updated, deleted, skipped = 0, 0, 0, 0
+
+    async def _apply(force=False):
+        nonlocal inserts, updates, deletes, inserted, updated, deleted, skipped
+        if inserts and (force or len(inserts) >= BATCH_SIZE):
+            await _write_jobs(conn, inserts)
+            inserted += len(inserts)
+            inserts = []
+        if updates and (force or len(updates) >= BATCH_SIZE):
+            updated += len(await conn.execute_query_dict(QUERY_SYNC_UPDATE, [list(column) for column in zip(*updates)]))
+            updates = []
+        if deletes and (force or len(deletes) >= BATCH_SIZE):
+            removed = len(await conn.execute_query_dict(QUERY_SYNC_DELETE, [deletes]))
+            deleted += removed
+            skipped += len(deletes) - removed
+            deletes = []
+
+    for range_id in sorted(changed):
+        low, high = range_id * SYNC_RANGE_SIZE, (range_id + 1) * SYNC_RANGE_SIZE
+        current = {
+            row["number"]: (row["url"], row["start_id"], row["end_id"], row["shard_of_chunk"])
+            for row in await conn.execute_query_dict(QUERY_RANGE_JOBS, [low, high])
+        }
+
+        batch = numbers[(numbers >= low) & (numbers < high)]
+        for row in _job_rows(manifest, directory, states, batch):
+            if row[0] not in current:
+                inserts.append(row)
+            elif current.pop(row[0]) != row[1:5]:
+                updates.append(row[:5])
+
+        deletes.extend(current)
+        await _apply()
+
+    await _apply(force=True)
+
+    print(f"Inserted {inserted:,} new jobs, updated {updated:,} changed jobs and deleted {deleted:,} removed jobs.")
+    if skipped:
+        print(f"Skipped deleting {skipped:,} jobs which are currently being worked on. (run the sync again later)")
+
+    # 4. Move jobs forward from open -> GPU -> closed. (jobs are never reopened)
+    print("Applying job states...")
+    gpu = 0
+    for gpu_jobs in _batches(iter_json_array("jobs/open_gpu.json")):
+        rows = {}
+        for data in gpu_jobs:
+            number = int(data[0])
+            if number < len(states) and states[number] == GPU and number not in rows:
+                rows[number] = data[1]["url"]
+        if rows:
+            gpu += len(await conn.execute_query_dict(QUERY_SYNC_GPU, [list(rows), list(rows.values())]))
+
+    closed = 0
+    for batch in _batches(np.flatnonzero(states == CLOSED).tolist()):
+        closed += len(await conn.execute_query_dict(QUERY_SYNC_CLOSE, [batch]))
+
+    print(f"Moved {gpu:,} jobs to GPU jobs and closed {closed:,} jobs.")
+
+    # The live counters in Redis are corrected by `reconcile_counters` on the server.
     print("Done.")
 
 
 
-run_async(init())
+run_async(sync() if "--sync" in sys.argv else init())